@@ -4,16 +4,35 @@ import os
 from typing import final
 
 DISCORD_BOT_TOKEN: final(str) = os.getenv('DISCORD_BOT_TOKEN')
-bot = commands.Bot(command_prefix='/', intents=discord.Intents.all())
+# 大きなサーバー向けに必要なintentsとキャッシュだけで動かすモード
+LEAN_MODE: final(bool) = os.getenv('PROGRESS_LEAN_MODE', '0') == '1'
+LEAN_MAX_MESSAGES: final(int) = 100
 
 
-async def load_extensions():
-    await bot.load_extension('source.main', package='.')
+class ProgressBot(commands.Bot):
+    # on_readyは再接続のたびに呼ばれるので、拡張の読み込みはログイン前に1度だけ行う。
+    async def setup_hook(self):
+        await self.load_extension('source.main', package='.')
 
 
-@bot.event
-async def on_ready():
-    await load_extensions()
+def create_bot() -> ProgressBot:
+    if not LEAN_MODE:
+        return ProgressBot(command_prefix='/', intents=discord.Intents.all())
+    # progressに登録されたチャンネルのメンバーと、報告メッセージのリアクションだけが必要。
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.members = True
+    intents.guild_messages = True
+    intents.guild_reactions = True
+    intents.message_content = True
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.joined = True
+    # メンバーは起動時に全サーバー分を取得せず、必要になったサーバーだけcogが取得する。
+    return ProgressBot(command_prefix='/', intents=intents, member_cache_flags=member_cache_flags,
+                       chunk_guilds_at_startup=False, max_messages=LEAN_MAX_MESSAGES)
 
 
-bot.run(DISCORD_BOT_TOKEN)
+# グラフ描画のワーカーはforkserverで起動され、このファイルを__main__以外として読み込むので、そのときは起動しない。
+if __name__ == '__main__':
+    bot = create_bot()
+    bot.run(DISCORD_BOT_TOKEN)
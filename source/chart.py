@@ -0,0 +1,108 @@
+import asyncio
+import collections
+import concurrent.futures
+import importlib.util
+import io
+import multiprocessing
+import os
+from typing import Callable, Hashable, List, Optional, Tuple
+
+CHART_ENABLED = os.getenv('PROGRESS_CHARTS', '0') == '1' and importlib.util.find_spec('matplotlib') is not None
+CHART_WORKERS = int(os.getenv('PROGRESS_CHART_WORKERS', '1'))
+CHART_CACHE_SIZE = 256
+# イベントループやto_threadのスレッドが動いているプロセスをforkするとロックの状態ごと複製されるので、forkは使わない。
+CHART_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+FONT_FAMILY = ['Noto Sans CJK JP', 'IPAexGothic', 'DejaVu Sans']
+
+
+# 以下の描画関数はプロセスプールのワーカー上で実行される。
+def _new_figure(height: float):
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+    pyplot.rcParams['font.family'] = FONT_FAMILY
+    return pyplot, pyplot.figure(figsize=(6.4, height), dpi=100)
+
+
+def _to_png(pyplot, figure) -> bytes:
+    buffer = io.BytesIO()
+    figure.tight_layout()
+    figure.savefig(buffer, format='png')
+    pyplot.close(figure)
+    return buffer.getvalue()
+
+
+def render_ranking(names: List[str], scores: List[int]) -> bytes:
+    pyplot, figure = _new_figure(height=max(2.0, 0.4 * len(names) + 1.0))
+    axes = figure.add_subplot()
+    positions = list(range(len(names)))
+    axes.barh(positions, scores, color='#5865f2')
+    axes.set_yticks(positions, labels=['{}. {}'.format(i + 1, name) for i, name in enumerate(names)])
+    axes.invert_yaxis()
+    axes.set_xlabel('score')
+    for position, score in zip(positions, scores):
+        axes.annotate(str(score), (score, position), xytext=(3, 0), textcoords='offset points', va='center')
+    return _to_png(pyplot, figure)
+
+
+def render_trend(labels: List[str], scores: List[int], streaks: List[int]) -> bytes:
+    pyplot, figure = _new_figure(height=4.0)
+    score_axes, streak_axes = figure.subplots(2, 1, sharex=True)
+    score_axes.plot(labels, scores, marker='o', color='#5865f2')
+    score_axes.set_ylabel('score')
+    streak_axes.bar(labels, streaks, color=['#57f287' if streak > 0 else '#ed4245' for streak in streaks])
+    streak_axes.axhline(0, color='gray', linewidth=0.8)
+    streak_axes.set_ylabel('streak')
+    streak_axes.tick_params(axis='x', labelrotation=45)
+    return _to_png(pyplot, figure)
+
+
+class ChartRenderer:
+    def __init__(self, enabled: bool = CHART_ENABLED, max_workers: int = CHART_WORKERS,
+                 cache_size: int = CHART_CACHE_SIZE):
+        self.enabled = enabled
+        self.max_workers = max_workers
+        self.cache_size = cache_size
+        self.executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        # key -> (version, png)。同じkeyは最新のversionだけを保持する。
+        self.cache: collections.OrderedDict[Hashable, Tuple[Hashable, bytes]] = collections.OrderedDict()
+        self.pending: dict[Tuple[Hashable, Hashable], asyncio.Future] = {}
+
+    async def render(self, key: Hashable, version: Hashable, func: Callable[..., bytes], *args) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] == version:
+            self.cache.move_to_end(key)
+            return cached[1]
+        if (key, version) in self.pending:
+            # 同じ描画が進行中なら結果を共有する。
+            try:
+                return await asyncio.shield(self.pending[(key, version)])
+            except Exception:
+                return None
+
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context(CHART_START_METHOD))
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        self.pending[(key, version)] = future
+        try:
+            image = await asyncio.shield(future)
+        except Exception as e:
+            print('failed to render chart {}: {!r}'.format(key, e))
+            return None
+        finally:
+            self.pending.pop((key, version), None)
+
+        self.cache[key] = (version, image)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return image
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.cache.clear()
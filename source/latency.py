@@ -0,0 +1,95 @@
+import asyncio
+import collections
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+import discord
+
+# Discordはinteractionに3秒以内の応答を求めるので、余裕をもってこの秒数を超えたらdeferする。
+INTERACTION_BUDGET = float(os.getenv('PROGRESS_INTERACTION_BUDGET', '2.0'))
+LATENCY_SAMPLES = 200
+PREDICT_MIN_SAMPLES = 5
+PREDICT_PERCENTILE = 0.9
+
+
+# interaction.responseの代わり。deferと編集が同時に起きないようにし、応答済みなら元のメッセージを編集する。
+# attachmentsを設定しておくと、次の編集で一緒に送る。
+class BudgetedResponse:
+    def __init__(self, interaction: discord.Interaction):
+        self.interaction = interaction
+        self.lock = asyncio.Lock()
+        self.attachments: Optional[list] = None
+
+    def is_done(self) -> bool:
+        return self.interaction.response.is_done()
+
+    async def defer(self, **kwargs):
+        async with self.lock:
+            if not self.interaction.response.is_done():
+                await self.interaction.response.defer(**kwargs)
+
+    async def edit_message(self, **kwargs):
+        async with self.lock:
+            if self.attachments is not None:
+                kwargs.setdefault('attachments', self.attachments)
+                self.attachments = None
+            if self.interaction.response.is_done():
+                kwargs.pop('delete_after', None)
+                kwargs.pop('suppress_embeds', None)
+                await self.interaction.edit_original_response(**kwargs)
+            else:
+                await self.interaction.response.edit_message(**kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self.interaction.response, name)
+
+
+class BudgetedInteraction:
+    def __init__(self, interaction: discord.Interaction):
+        self.interaction = interaction
+        self.response = BudgetedResponse(interaction=interaction)
+
+    def __getattr__(self, name: str):
+        return getattr(self.interaction, name)
+
+
+class InteractionBudget:
+    def __init__(self, budget: float = INTERACTION_BUDGET):
+        self.budget = budget
+        self.latencies: collections.defaultdict[str, collections.deque] = collections.defaultdict(
+            lambda: collections.deque(maxlen=LATENCY_SAMPLES))
+        self.calls: collections.Counter[str] = collections.Counter()
+        self.deferred: collections.Counter[str] = collections.Counter()
+
+    def percentile(self, name: str, q: float) -> Optional[float]:
+        samples = sorted(self.latencies[name])
+        if len(samples) == 0:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def predicts_slow(self, name: str) -> bool:
+        if len(self.latencies[name]) < PREDICT_MIN_SAMPLES:
+            return False
+        return self.percentile(name, PREDICT_PERCENTILE) > self.budget
+
+    # 遅いと予測されるhandlerはすぐにdeferし、そうでなくても予算を超えた時点でdeferして残りの処理を続ける。
+    async def run(self, name: str, interaction: discord.Interaction, handler: Callable[..., Awaitable], *args,
+                  **kwargs):
+        budgeted_interaction = BudgetedInteraction(interaction=interaction)
+        start = time.perf_counter()
+        try:
+            if self.predicts_slow(name):
+                await budgeted_interaction.response.defer()
+                self.deferred[name] += 1
+            task = asyncio.ensure_future(handler(*args, interaction=budgeted_interaction, **kwargs))
+            try:
+                await asyncio.wait_for(asyncio.shield(task), timeout=self.budget)
+            except asyncio.TimeoutError:
+                if not budgeted_interaction.response.is_done():
+                    await budgeted_interaction.response.defer()
+                    self.deferred[name] += 1
+                await task
+        finally:
+            self.calls[name] += 1
+            self.latencies[name].append(time.perf_counter() - start)
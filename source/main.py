@@ -1,15 +1,18 @@
+import asyncio
 import datetime
 import enum
+import functools
+import io
 import os
+import signal
 import zoneinfo
 from typing import List, Optional, Union
 
 import discord
-import psycopg2
-import psycopg2.extras
 from discord import app_commands
 from discord.ext import commands, tasks
 
+from . import chart, latency, memwatch, model, pacing, profiling, storage
 from .UtilityClasses_DiscordBot import base
 
 DATABASE_URL = os.getenv('DATABASE_URL')
@@ -24,6 +27,16 @@ DEFAULT_TIMES = [
 ]
 MAX_HP = 3
 HEAL_HP_PER_STREAK = 3
+HISTORY_RETENTION = datetime.timedelta(days=60)
+# 集計のときに報告メッセージを1件ずつ取得せず、最初の報告から最後の報告までの履歴をまとめて取得する。
+HISTORY_PREFETCH = os.getenv('PROGRESS_HISTORY_PREFETCH', '1') == '1'
+# 報告がこれより少ないときは1件ずつ取得したほうがリクエストが少ない。
+HISTORY_PREFETCH_MIN_REPORTS = 2
+# 履歴は1回のリクエストで100件ずつ取得される。
+HISTORY_PAGE_SIZE = 100
+# /progressで作られたRunnerはこの時間が過ぎるか、数が上限を超えたら古いものから破棄する。
+RUNNER_LIFETIME = datetime.timedelta(minutes=30)
+MAX_RUNNERS = 100
 THINKING_FACE = base.Emoji(
     discord=':thinking_face:',
     text='\N{thinking face}',
@@ -72,6 +85,15 @@ def calc_nearest_datetime(standard: datetime.datetime, _time: datetime.time) ->
     return nearest_datetime
 
 
+# DBの処理を含むRunnerのhandlerはInteractionBudgetを通して実行する。
+def budgeted(method):
+    @functools.wraps(method)
+    async def wrapper(self: 'Runner', interaction: discord.Interaction, **kwargs):
+        async with self.command.profiler.profile('interaction', method.__name__):
+            await self.command.interaction_budget.run(method.__name__, interaction, method, self, **kwargs)
+    return wrapper
+
+
 class SettingChannelSelect(discord.ui.ChannelSelect):
     def __init__(self, runner: 'Runner'):
         super().__init__(channel_types=[discord.ChannelType.text])
@@ -211,7 +233,7 @@ class JoinProgress(discord.ui.Button):
         self.runner = runner
 
     async def callback(self, interaction: discord.Interaction):
-        await self.runner.join(interaction)
+        await self.runner.join(interaction=interaction)
 
 
 class LeaveProgress(discord.ui.Button):
@@ -266,6 +288,20 @@ class ProgressWindow(base.Window):
         ERROR_ON_MEMBER_STATUS = 9
 
     def __init__(self, runner: 'Runner'):
+        view_patterns = [
+            [SettingChannelSelect(runner=runner), BackMenuButton(runner=runner)],
+            [IntervalDaysSelect(runner=runner), HourSelect(runner=runner), MinuteSelect(runner=runner),
+             NextDaySelect(runner=runner), AddButton(runner=runner), BackButton(runner=runner)],
+            [IntervalDaysSelect(runner=runner), HourSelect(runner=runner), MinuteSelect(runner=runner),
+             NextDaySelect(runner=runner), EditButton(runner=runner), BackButton(runner=runner),
+             DeleteButton(runner=runner)],
+            [BackButton(runner=runner)], [BackButton(runner=runner)], [BackButton(runner=runner)],
+            [MembersButton(runner=runner), SettingButton(runner=runner)],
+            [TextChannelSelectOnMemberStatus(runner=runner), MemberSelect(runner=runner),
+             BackMenuButton(runner=runner)],
+            [LeaveProgress(runner=runner), BackMembersButton(runner=runner)],
+            [JoinProgress(runner=runner), BackMembersButton(runner=runner)]
+        ]
         super().__init__(patterns=10, embed_patterns=[
             {'title': '進捗報告チャンネル　設定',
              'description': '進捗報告用のチャンネルを設定できます。進捗報告がないメンバーには催促のメンションが飛びます。'},
@@ -279,28 +315,24 @@ class ProgressWindow(base.Window):
             {'title': '進捗報告　状況', 'description': 'メンバーの進捗報告状況が確認できます。'},
             {'title': 'member name'},
             {'title': 'エラー', 'color': discord.Colour.orange().value}
-        ], view_patterns=[
-            [SettingChannelSelect(runner=runner), BackMenuButton(runner=runner)],
-            [IntervalDaysSelect(runner=runner), HourSelect(runner=runner), MinuteSelect(runner=runner),
-             NextDaySelect(runner=runner), AddButton(runner=runner), BackButton(runner=runner)],
-            [IntervalDaysSelect(runner=runner), HourSelect(runner=runner), MinuteSelect(runner=runner),
-             NextDaySelect(runner=runner), EditButton(runner=runner), BackButton(runner=runner),
-             DeleteButton(runner=runner)],
-            [BackButton(runner=runner)], [BackButton(runner=runner)], [BackButton(runner=runner)],
-            [MembersButton(runner=runner), SettingButton(runner=runner)],
-            [TextChannelSelectOnMemberStatus(runner=runner), MemberSelect(runner=runner),
-             BackMenuButton(runner=runner)],
-            [LeaveProgress(runner=runner), BackMembersButton(runner=runner)],
-            [JoinProgress(runner=runner), BackMembersButton(runner=runner)]
-        ])
+        ], view_patterns=view_patterns)
+        self.items: List[discord.ui.Item] = [item for pattern in view_patterns for item in pattern]
+
+    # discord.pyは止められていないviewを保持し続け、viewからボタン、Runnerまでが解放されない。
+    # 破棄するときはボタンなどが入っているviewをすべて止める。
+    def stop_views(self):
+        for view in {item.view for item in self.items if item.view is not None}:
+            if not view.is_finished():
+                view.stop()
 
 
 class Runner(base.Runner):
-    def __init__(self, command: 'Progress', channel: discord.TextChannel, database_connector):
+    def __init__(self, command: 'Progress', channel: discord.TextChannel, storage: 'storage.Storage'):
         super().__init__(channel=channel)
         self.command = command
         self.progress_window = ProgressWindow(runner=self)
-        self.database_connector = database_connector
+        self.storage = storage
+        self.created_at = datetime.datetime.now(tz=ZONE_UTC)
         self.chosen_channel: Optional[discord.TextChannel] = None
         self.prev_interval: Optional[datetime.timedelta] = None
         self.interval: Optional[datetime.timedelta] = None
@@ -312,28 +344,29 @@ class Runner(base.Runner):
         self.chosen_channel_on_member_status: Union[
             discord.app_commands.AppCommandChannel, discord.app_commands.AppCommandThread, None] = None
         self.chosen_member_on_member_status: Union[discord.Member, discord.User, None] = None
+        self.chart_attached = False
+
+    def close(self):
+        self.progress_window.stop_views()
 
     async def run(self):
         self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.MENU)
         await self.progress_window.send(sender=self.channel)
 
+    @budgeted
     async def select_channel(self, values: List[discord.app_commands.AppCommandChannel],
                              interaction: discord.Interaction):
         assert len(values) == 1
         self.chosen_channel = values[0].resolve()
-        with self.database_connector.cursor() as cur:
-            cur.execute('SELECT interval, time, timestamp FROM progress WHERE channel_id = %s',
-                        (self.chosen_channel.id,))
-            results = cur.fetchall()
-            self.database_connector.commit()
-        if len(results) == 0:
+        result = await asyncio.to_thread(self.storage.get_progress, channel_id=self.chosen_channel.id)
+        if result is None:
             self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.ADD)
             self.progress_window.embed_dict['title'] = '追加 #{}'.format(self.chosen_channel.name)
-        elif len(results) == 1:
-            self.prev_interval = results[0][0]
-            self.prev_time = datetime.datetime.combine(date=datetime.date.today(), time=results[0][1],
+        else:
+            self.prev_interval = result[0]
+            self.prev_time = datetime.datetime.combine(date=datetime.date.today(), time=result[1],
                                                        tzinfo=ZONE_UTC).astimezone(tz=ZONE_TOKYO).time()
-            self.prev_next_date = results[0][2].astimezone(tz=ZONE_TOKYO).date()
+            self.prev_next_date = result[2].astimezone(tz=ZONE_TOKYO).date()
             self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.EDIT)
             self.progress_window.embed_dict['title'] = '変更 #{}'.format(self.chosen_channel.name)
             self.progress_window.embed_dict['fields'] = [
@@ -341,10 +374,9 @@ class Runner(base.Runner):
                 {'name': '送信する時刻', 'value': '{0}時{1}分'.format(self.prev_time.hour, self.prev_time.minute)},
                 {'name': '次に送信される日付', 'value': str(self.prev_next_date)}
             ]
-        else:
-            raise ValueError
         await self.progress_window.response_edit(interaction=interaction)
 
+    @budgeted
     async def add(self, interaction: discord.Interaction):
         if self.interval is None or self.hour is None or self.minute is None or self.next_date is None:
             self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.ADD)
@@ -361,24 +393,9 @@ class Runner(base.Runner):
                 self.progress_window.embed_dict['fields'] = [
                     {'name': 'エラー', 'value': '次回の時刻は現在以降の時刻を設定してください。'}]
             else:
-                with self.database_connector.cursor() as cur:
-                    cur.execute('SELECT channel_id FROM progress WHERE channel_id = %s', (self.chosen_channel.id,))
-                    results = cur.fetchall()
-                    if len(results) == 0:
-                        cur.execute(
-                            'INSERT INTO progress (channel_id, interval, time, timestamp, prev_timestamp,'
-                            ' prev_prev_timestamp) VALUES (%s, %s, %s, %s, %s, %s)',
-                            (self.chosen_channel.id, self.interval, new_time_utc, next_datetime,
-                             next_datetime - self.interval, next_datetime - self.interval * 2)
-                        )
-                        self.database_connector.commit()
-                    else:
-                        cur.execute(
-                            'UPDATE progress SET interval = %s, time = %s, timestamp = %s WHERE channel_id = %s',
-                            (self.interval, new_time_utc, next_datetime, self.chosen_channel.id)
-                        )
-                        self.database_connector.commit()
-                self.command.change_printer_interval()
+                await asyncio.to_thread(self.storage.save_progress, channel_id=self.chosen_channel.id,
+                                        interval=self.interval, _time=new_time_utc, timestamp=next_datetime)
+                await self.command.change_printer_interval()
                 self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.ADDED)
                 self.progress_window.embed_dict['fields'] = [
                     {'name': '送信する間隔', 'value': '{}日ごと'.format(self.interval.days)},
@@ -387,6 +404,7 @@ class Runner(base.Runner):
                 ]
         await self.progress_window.response_edit(interaction=interaction)
 
+    @budgeted
     async def edit(self, interaction: discord.Interaction):
         if self.interval is None or self.hour is None or self.minute is None or self.next_date is None:
             self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.EDIT)
@@ -403,24 +421,9 @@ class Runner(base.Runner):
                 self.progress_window.embed_dict['fields'] = [
                     {'name': 'エラー', 'value': '次回の時刻は現在以降の時刻を設定してください。'}]
             else:
-                with self.database_connector.cursor() as cur:
-                    cur.execute('SELECT channel_id FROM progress WHERE channel_id = %s', (self.chosen_channel.id,))
-                    results = cur.fetchall()
-                    if len(results) == 0:
-                        cur.execute(
-                            'INSERT INTO progress (channel_id, interval, time, timestamp, prev_timestamp,'
-                            ' prev_prev_timestamp) VALUES (%s, %s, %s, %s, %s, %s)',
-                            (self.chosen_channel.id, self.interval, new_time_utc, next_datetime,
-                             next_datetime - self.interval, next_datetime - self.interval * 2)
-                        )
-                        self.database_connector.commit()
-                    else:
-                        cur.execute(
-                            'UPDATE progress SET interval = %s, time = %s, timestamp = %s WHERE channel_id = %s',
-                            (self.interval, new_time_utc, next_datetime, self.chosen_channel.id)
-                        )
-                        self.database_connector.commit()
-                self.command.change_printer_interval()
+                await asyncio.to_thread(self.storage.save_progress, channel_id=self.chosen_channel.id,
+                                        interval=self.interval, _time=new_time_utc, timestamp=next_datetime)
+                await self.command.change_printer_interval()
                 self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.EDITED)
                 self.progress_window.embed_dict['fields'] = [
                     {'name': '送信する間隔', 'value': '{}日ごと'.format(self.interval.days)},
@@ -433,11 +436,10 @@ class Runner(base.Runner):
         self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.SETTING)
         await self.progress_window.response_edit(interaction=interaction)
 
+    @budgeted
     async def delete(self, interaction: discord.Interaction):
-        with self.database_connector.cursor() as cur:
-            cur.execute('DELETE FROM progress WHERE channel_id = %s', (self.chosen_channel.id,))
-            self.database_connector.commit()
-        self.command.change_printer_interval()
+        await asyncio.to_thread(self.storage.delete_progress, channel_id=self.chosen_channel.id)
+        await self.command.change_printer_interval()
         self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.DELETED)
         await self.progress_window.response_edit(interaction=interaction)
 
@@ -453,6 +455,7 @@ class Runner(base.Runner):
         self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.MENU)
         await self.progress_window.response_edit(interaction=interaction)
 
+    @budgeted
     async def move_member_status(self, interaction: discord.Interaction):
         if self.chosen_member_on_member_status is None or self.chosen_channel_on_member_status is None:
             await interaction.response.defer()
@@ -465,33 +468,23 @@ class Runner(base.Runner):
                     self.chosen_channel_on_member_status.name)
                 await self.progress_window.response_edit(interaction=interaction)
             else:
-                with self.database_connector.cursor() as cur:
-                    cur.execute(
-                        'SELECT * FROM progress WHERE channel_id = %s', (channel.id,)
-                    )
-                    results = cur.fetchall()
-                if len(results) == 0:
+                if await asyncio.to_thread(self.storage.get_progress, channel_id=channel.id) is None:
                     self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.ERROR_ON_MEMBER_STATUS)
                     self.progress_window.embed_dict['title'] = '# {0}は進捗報告チャンネルとして登録されていません。'.format(
                         channel.name)
                     await self.progress_window.response_edit(interaction=interaction)
-                elif len(results) == 1:
+                else:
+                    await self.command.ensure_members(channel.guild)
                     if self.chosen_member_on_member_status in channel.members:
-                        with self.database_connector.cursor() as cur:
-                            cur.execute(
-                                'SELECT score, total, streak, escape, denied FROM progress_members'
-                                ' WHERE channel_id = %s AND user_id = %s',
-                                (channel.id, self.chosen_member_on_member_status.id)
-                            )
-                            results = cur.fetchall()
-                            self.database_connector.commit()
-                        if len(results) == 0:
+                        result = await asyncio.to_thread(self.storage.get_member, channel_id=channel.id,
+                                                         user_id=self.chosen_member_on_member_status.id)
+                        if result is None:
                             self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.ERROR_ON_MEMBER_STATUS)
                             self.progress_window.embed_dict['title'] = '{0}さんは# {1}のprogressに参加していません'.format(
                                 self.chosen_member_on_member_status.name, channel.name)
                             await self.progress_window.response_edit(interaction=interaction)
-                        elif len(results) == 1:
-                            score, total, streak, escape, denied = results[0]
+                        else:
+                            score, total, streak, escape, denied = result
                             self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.MEMBER_STATUS)
                             self.progress_window.embed_dict['title'] = '*{}*'.format(
                                 self.chosen_member_on_member_status.name)
@@ -505,94 +498,126 @@ class Runner(base.Runner):
                                 {'name': '却下された回数', 'value': '{}回'.format(denied)},
                                 {'name': '報告無し連続日数', 'value': '{}日'.format(max(-streak, 0))}
                             ]
+                            trend = await self.render_trend(channel_id=channel.id,
+                                                            user_id=self.chosen_member_on_member_status.id)
+                            # 画像が欠けて表示されないように、embedと同じ編集で添付する。
+                            if trend is not None:
+                                self.progress_window.embed_dict['image'] = {'url': 'attachment://trend.png'}
+                                interaction.response.attachments = [
+                                    discord.File(io.BytesIO(trend), filename='trend.png')]
                             await self.progress_window.response_edit(interaction=interaction)
-                        else:
-                            raise RuntimeError
+                            self.chart_attached = trend is not None
                     else:
                         self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.ERROR_ON_MEMBER_STATUS)
                         self.progress_window.embed_dict['title'] = '{0}は# {1}に参加していません。'.format(
                             self.chosen_member_on_member_status.name, channel.name)
                         await self.progress_window.response_edit(interaction=interaction)
-                else:
-                    raise RuntimeError
                 self.chosen_member_on_member_status = None
                 self.chosen_channel_on_member_status = None
 
+    async def render_trend(self, channel_id: int, user_id: int) -> Optional[bytes]:
+        if not self.command.chart_renderer.enabled:
+            return None
+        results = await asyncio.to_thread(self.storage.list_history, channel_id=channel_id, user_id=user_id)
+        if len(results) == 0:
+            return None
+        # 集計のたびに履歴が増えるので、最新の履歴の時刻をデータのバージョンとする。
+        return await self.command.chart_renderer.render(
+            ('trend', channel_id, user_id), results[-1][0], chart.render_trend,
+            [_timestamp.astimezone(tz=ZONE_TOKYO).strftime('%m/%d %H:%M') for _timestamp, _, _ in results],
+            [score for _, score, _ in results], [streak for _, _, streak in results]
+        )
+
+    @budgeted
     async def back_members(self, interaction: discord.Interaction):
         self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.MEMBERS)
+        if self.chart_attached:
+            interaction.response.attachments = []
+            self.chart_attached = False
         await self.progress_window.response_edit(interaction=interaction)
 
+    @budgeted
     async def join(self, interaction: discord.Interaction):
-        with self.database_connector.cursor() as cur:
-            cur.execute(
-                'INSERT INTO progress_members (channel_id, user_id, total, streak, escape, denied, score)'
-                ' VALUES (%s, %s, 0, 0, 0, 0, 0)', (
-                    self.channel.id, self.chosen_member_on_member_status
-                )
-            )
-            self.database_connector.commit()
+        await asyncio.to_thread(self.storage.add_member, channel_id=self.channel.id,
+                                user_id=self.chosen_member_on_member_status)
         self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.MEMBER_STATUS)
         await self.progress_window.response_edit(interaction=interaction)
 
     async def leave(self, interaction: discord.Interaction):
-        with self.database_connector.cursor() as cur:
-            cur.execute(
-                'DELETE FROM progress_members WHERE channel_id = %s AND user_id = %s', (
-                    self.channel.id, self.chosen_member_on_member_status.id
-                )
-            )
-            self.database_connector.commit()
+        await asyncio.to_thread(self.storage.remove_member, channel_id=self.channel.id,
+                                user_id=self.chosen_member_on_member_status.id)
         self.progress_window.set_pattern(pattern_id=ProgressWindow.WindowID.ERROR_ON_MEMBER_STATUS)
         await self.progress_window.response_edit(interaction=interaction)
 
 
-def calc_score(approved: int, denied: int, streak: int):
-    return approved * 100 - denied * 50 + streak * 10
-
-
 class Progress(base.Command):
     def __init__(self, bot: discord.ext.commands.Bot):
         super().__init__(bot=bot)
+        self.chart_renderer = chart.ChartRenderer()
+        self.interaction_budget = latency.InteractionBudget()
+        self.profiler = profiling.Profiler()
+        self.memory_watch = memwatch.MemoryWatch()
+        self.tally_pacer = pacing.TallyPacer()
+        self.parser.add_argument('comment')
+        self.storage: Optional[storage.Storage] = None
+
+    # Databaseの初期化。接続とマイグレーションはイベントループを止めないように別スレッドで行う。
+    async def cog_load(self):
+        self.storage = await asyncio.to_thread(storage.connect, DATABASE_URL)
+        version = await asyncio.to_thread(self.storage.migrate)
+        print('database schema version: {}'.format(version))
+        await asyncio.to_thread(self.storage.prepare)
+        new_time = await asyncio.to_thread(self.load_printer_times)
+        self.tally_progress_periodically.change_interval(time=new_time)
         self.tally_progress_periodically.start()
+        self.maintain_reports_periodically.start()
+        self.memory_watch.start()
         print(self.tally_progress_periodically.next_iteration)
-        self.parser.add_argument('comment')
-
-        # Databaseの初期化
-        self.database_connector = psycopg2.connect(DATABASE_URL)
-        with self.database_connector.cursor() as cur:
-            cur.execute(
-                'CREATE TABLE IF NOT EXISTS progress (channel_id BIGINT, interval INTERVAL, time TIME,'
-                ' timestamp TIMESTAMPTZ, prev_timestamp TIMESTAMPTZ, prev_prev_timestamp TIMESTAMPTZ,'
-                ' PRIMARY KEY (channel_id))')
-            self.database_connector.commit()
-        self.change_printer_interval()
-
-        with self.database_connector.cursor() as cur:
-            cur.execute(
-                'CREATE TABLE IF NOT EXISTS progress_members (channel_id BIGINT, user_id BIGINT, score INTEGER,'
-                ' total INTEGER, streak INTEGER, escape INTEGER, denied INTEGER, PRIMARY KEY (channel_id, user_id))'
-            )
-            self.database_connector.commit()
-
-        with self.database_connector.cursor() as cur:
-            cur.execute(
-                'CREATE TABLE IF NOT EXISTS progress_reports (channel_id BIGINT, user_id BIGINT, message_id BIGINT,'
-                ' timestamp TIMESTAMPTZ, PRIMARY KEY (channel_id, user_id, message_id))'
-            )
-            self.database_connector.commit()
-
-    def change_printer_interval(self):
+        # SIGUSR1で次の集計を計測する。
+        if hasattr(signal, 'SIGUSR1'):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.profiler.arm, 'tally', 1)
+
+    async def cog_unload(self):
+        for runner in self.runners:
+            runner.close()
+        self.runners.clear()
+        self.tally_progress_periodically.cancel()
+        self.maintain_reports_periodically.cancel()
+        if hasattr(signal, 'SIGUSR1'):
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+        self.chart_renderer.close()
+        self.memory_watch.stop()
+        if self.storage is not None:
+            self.storage.close()
+
+    def prune_runners(self):
+        now = datetime.datetime.now(tz=ZONE_UTC)
+        alive = [runner for runner in self.runners if now - runner.created_at < RUNNER_LIFETIME][-MAX_RUNNERS:]
+        for runner in self.runners:
+            if runner not in alive:
+                runner.close()
+        self.runners[:] = alive
+
+    # lean modeでは起動時にメンバーを取得しないので、登録されたチャンネルのサーバーだけ必要になったときに取得する。
+    async def ensure_members(self, guild: discord.Guild):
+        if not guild.chunked:
+            print('chunk members of {}.'.format(guild.name))
+            await guild.chunk(cache=True)
+
+    def load_printer_times(self) -> List[datetime.time]:
+        return [datetime.datetime.combine(date=datetime.datetime.now(tz=ZONE_TOKYO), time=_time).astimezone(
+            tz=ZONE_UTC).timetz() for _time in DEFAULT_TIMES] + [
+            _time.replace(tzinfo=ZONE_UTC) for _time in self.storage.list_progress_times()]
+
+    async def change_printer_interval(self):
         print('changed printer interval.')
-        with self.database_connector.cursor() as cur:
-            cur.execute('SELECT time FROM progress')
-            results = cur.fetchall()
-        new_time = [datetime.datetime.combine(date=datetime.datetime.now(tz=ZONE_TOKYO), time=_time).astimezone(
-            tz=ZONE_UTC).timetz() for _time in DEFAULT_TIMES] + [_time.replace(tzinfo=ZONE_UTC) for _time, in results]
+        new_time = await asyncio.to_thread(self.load_printer_times)
         for _time in new_time:
             print(_time.tzinfo)
             print(_time)
+        # 集計中にrestartするとloopのtaskごと取り消され、順番待ちのchannelと集計途中のchannelが次の時刻まで残る。
+        # change_intervalは待機中のloopの次の時刻を計算し直すので、それだけで足りる。
         self.tally_progress_periodically.change_interval(time=new_time)
-        self.tally_progress_periodically.restart()
         print(self.tally_progress_periodically.time)
 
     @commands.command()
@@ -603,7 +628,8 @@ class Progress(base.Command):
         try:
             namespace = self.parser.parse_args(args=args)
         except base.commandparser.InputInsufficientRequiredArgumentError:
-            self.runners.append(Runner(command=self, channel=ctx.channel, database_connector=self.database_connector))
+            self.prune_runners()
+            self.runners.append(Runner(command=self, channel=ctx.channel, storage=self.storage))
             await self.runners[len(self.runners) - 1].run()
         else:
             embed = discord.Embed(
@@ -614,12 +640,70 @@ class Progress(base.Command):
             embed.set_footer(text='進捗報告')
             message = await ctx.send(embed=embed)
             await message.add_reaction('\N{thinking face}')
-            with self.database_connector.cursor() as cur:
-                cur.execute(
-                    'INSERT INTO progress_reports (channel_id, message_id, user_id, timestamp) VALUES (%s, %s, %s, %s)',
-                    (ctx.channel.id, message.id, ctx.author.id, message.created_at)
+            await asyncio.to_thread(self.storage.add_report, channel_id=ctx.channel.id, message_id=message.id,
+                                    user_id=ctx.author.id, timestamp=message.created_at)
+
+    # 管理者向けの統計。
+    @commands.command()
+    @commands.is_owner()
+    async def progress_stats(self, ctx: commands.Context):
+        embeds = []
+        await asyncio.to_thread(self.storage.refresh_stats)
+        embed = discord.Embed(title='SQL 実行統計', colour=discord.Colour.dark_gray())
+        for stats in sorted(self.storage.stats.values(), key=lambda _stats: _stats.calls, reverse=True)[:25]:
+            if stats.calls == 0:
+                continue
+            if stats.saved_ms is None:
+                value = '{}回'.format(stats.calls)
+            elif stats.generic_plans is None:
+                value = '{0}回 計画時間{1:.3f}ms 節約最大{2:.1f}ms'.format(stats.calls, stats.planning_ms,
+                                                                      stats.upper_bound_ms)
+            else:
+                value = '{0}回 計画時間{1:.3f}ms 汎用計画{2}回 節約{3:.1f}ms'.format(
+                    stats.calls, stats.planning_ms, stats.generic_plans, stats.saved_ms)
+            embed.add_field(name=stats.name, value=value, inline=False)
+        embeds.append(embed)
+
+        embed = discord.Embed(title='interaction 応答時間', colour=discord.Colour.dark_gray(),
+                              description='予算 {:.1f}秒'.format(self.interaction_budget.budget))
+        for name in sorted(self.interaction_budget.latencies)[:25]:
+            embed.add_field(name=name, value='p50 {0:.2f}s / p90 {1:.2f}s / p99 {2:.2f}s ({3}回中{4}回defer)'.format(
+                self.interaction_budget.percentile(name, 0.5), self.interaction_budget.percentile(name, 0.9),
+                self.interaction_budget.percentile(name, 0.99), self.interaction_budget.calls[name], self.interaction_budget.deferred[name]
+            ), inline=False)
+        embeds.append(embed)
+
+        if len(self.tally_pacer.ticks) > 0:
+            embed = discord.Embed(title='集計の負荷分散', colour=discord.Colour.dark_gray(),
+                                  description='{0:.1f}件/秒 / 分散幅上限 {1:.0f}秒 / 揺らぎ {2:.1f}秒 / 即時 {3}件'.format(
+                                      self.tally_pacer.rate, self.tally_pacer.window, self.tally_pacer.jitter,
+                                      self.tally_pacer.burst))
+            for tick in list(self.tally_pacer.ticks)[-10:]:
+                embed.add_field(
+                    name=tick.timestamp.astimezone(tz=ZONE_TOKYO).strftime('%m月%d日%H時%M分'),
+                    value='{0}件 / 分散{1:.1f}秒 / 所要{2:.1f}秒 / 最大遅延{3:.1f}秒 / 失敗{4}件'.format(
+                        tick.due, tick.window, tick.duration, tick.max_lateness, len(tick.failed)),
+                    inline=False
                 )
-                self.database_connector.commit()
+            embeds.append(embed)
+
+        if len(self.memory_watch.samples) > 0:
+            sample = self.memory_watch.samples[-1]
+            embed = discord.Embed(title='メモリ', colour=discord.Colour.dark_gray(), description='\n'.join(
+                ['tracemalloc {0:.1f}MiB / Runner {1} / View {2}'.format(
+                    sample.traced / 2 ** 20, sample.runners, sample.views)] + self.memory_watch.top_growth()))
+            embeds.append(embed)
+        await ctx.send(embeds=embeds)
+
+    # 次のcount回のchannelごとの集計(tally)またはinteractionを計測する。
+    @commands.command()
+    @commands.is_owner()
+    async def progress_profile(self, ctx: commands.Context, kind: str, count: int = 1):
+        if kind not in profiling.KINDS:
+            await ctx.send('{}のいずれかを指定してください。'.format(', '.join(profiling.KINDS)))
+            return
+        self.profiler.arm(kind=kind, count=count)
+        await ctx.send('次の{0}回の{1}を計測して{2}に保存します。'.format(count, kind, self.profiler.directory))
 
     @discord.app_commands.command(description='進捗報告ができます。')
     @app_commands.describe(context='進捗内容', description='進捗内容の詳細', image='大きく表示する画像のURL',
@@ -639,276 +723,242 @@ class Progress(base.Command):
         await interaction.response.send_message(embed=embed)
         message = await interaction.original_response()
         await message.add_reaction('\N{thinking face}')
-        with self.database_connector.cursor() as cur:
-            cur.execute(
-                'INSERT INTO progress_reports (channel_id, message_id, user_id, timestamp) VALUES (%s, %s, %s, %s)',
-                (interaction.channel.id, message.id, author.id, message.created_at)
-            )
-            self.database_connector.commit()
+        await asyncio.to_thread(self.storage.add_report, channel_id=interaction.channel.id, message_id=message.id,
+                                user_id=author.id, timestamp=message.created_at)
+
+    # 報告メッセージを履歴からまとめて取得する。IDは送信時刻順なので、最初の報告から古い順にたどり、すべて見つかったら止める。
+    # 間に他のメッセージが多いときでも、1件ずつ取得する場合よりリクエストが増えないように取得する件数を抑える。
+    # 範囲を最後までたどって見つからなかった報告は削除されたものとしてNoneにし、たどりきれなかった報告は含めない。
+    @staticmethod
+    async def prefetch_messages(channel: discord.TextChannel,
+                                message_ids: set[int]) -> dict[int, Optional[discord.Message]]:
+        messages: dict[int, Optional[discord.Message]] = {}
+        count = 0
+        limit = HISTORY_PAGE_SIZE * len(message_ids)
+        async for message in channel.history(limit=limit, after=discord.Object(id=min(message_ids) - 1),
+                                             before=discord.Object(id=max(message_ids) + 1), oldest_first=True):
+            count += 1
+            if message.id in message_ids:
+                messages[message.id] = message
+                if len(messages) == len(message_ids):
+                    break
+        if count < limit:
+            for message_id in message_ids:
+                messages.setdefault(message_id, None)
+        return messages
+
+    # 報告メッセージを取得する。削除されていればNoneを返す。
+    @staticmethod
+    async def fetch_report(channel: discord.TextChannel, message_id: int,
+                           messages: Optional[dict[int, Optional[discord.Message]]]) -> Optional[discord.Message]:
+        if messages is not None and message_id in messages:
+            return messages[message_id]
+        try:
+            return await channel.fetch_message(message_id)
+        except discord.NotFound:
+            return None
+
+    # 古い進捗報告を削除する。
+    @tasks.loop(hours=6)
+    async def maintain_reports_periodically(self):
+        await asyncio.to_thread(self.storage.maintain_reports, datetime.datetime.now(tz=ZONE_UTC))
 
     # 進捗を集計する。設定した時刻に呼ばれる。
     @tasks.loop(time=DEFAULT_TIMES)
     async def tally_progress_periodically(self):
+        await self.tally_progress()
+        self.prune_runners()
+        self.memory_watch.sample(runners=len(self.runners))
+
+    # setup_hookから読み込まれるのでログイン前にループが始まる。channelやmemberのキャッシュが揃うまで待つ。
+    @maintain_reports_periodically.before_loop
+    @tally_progress_periodically.before_loop
+    async def wait_until_ready(self):
+        await self.bot.wait_until_ready()
+
+    async def tally_progress(self):
         print('tally progress.')
         now = datetime.datetime.now(tz=ZONE_UTC)
-        with self.database_connector.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute(
-                'SELECT channel_id, interval, time, timestamp, prev_timestamp, prev_prev_timestamp FROM progress')
-            results = cur.fetchall()
-            self.database_connector.commit()
-
-        # 登録されているprogressごとに集計する。
-        for channel_id, interval, _time, timestamp, prev_timestamp, prev_prev_timestamp in results:
-            timestamp = timestamp.astimezone(tz=ZONE_UTC)
-            prev_timestamp = prev_timestamp.astimezone(tz=ZONE_UTC)
-            prev_prev_timestamp = prev_prev_timestamp.astimezone(tz=ZONE_UTC)
+        # 登録されているprogressのうち予定時刻になったものを集計する。
+        due = []
+        for row in await asyncio.to_thread(self.storage.list_progress):
+            progress = model.ChannelState(*row)
             print('現在:{}'.format(now))
-            print('予定時刻:{}'.format(timestamp))
-            print('前回時刻:{}'.format(prev_timestamp))
-            print('前々回時刻{}'.format(prev_prev_timestamp))
-            if now + datetime.timedelta(minutes=1) < timestamp:
+            print('予定時刻:{}'.format(progress.timestamp))
+            print('前回時刻:{}'.format(progress.prev_timestamp))
+            print('前々回時刻{}'.format(progress.prev_prev_timestamp))
+            if now + datetime.timedelta(minutes=1) < progress.timestamp:
                 continue
-            channel = self.bot.get_channel(channel_id)
-            # 登録されているchannelが存在しなかったらそのprogressを削除する。
-            if channel is None:
-                with self.database_connector.cursor() as cur:
-                    cur.execute(
-                        'DELETE FROM progress WHERE channel_id = %s', (channel_id,)
-                    )
-                    self.database_connector.commit()
+            due.append(progress)
+        stats = await self.tally_pacer.run(due, functools.partial(self.profile_tally_channel, now=now))
+        print('tallied {0} channels in {1:.1f}s (max lateness {2:.1f}s, {3} failed).'.format(
+            stats.due, stats.duration, stats.max_lateness, len(stats.failed)))
+
+    # cProfileはスレッド全体を計測するので、間隔をあけて進む集計全体ではなくchannelごとに計測する。
+    async def profile_tally_channel(self, progress: model.ChannelState, now: datetime.datetime):
+        async with self.profiler.profile('tally', str(progress.channel_id)):
+            await self.tally_channel(progress=progress, now=now)
+
+    # 1つのchannelの集計。メンバーごとの値はstateにまとめ、検証から催促、ランキングまで同じものを使う。
+    async def tally_channel(self, progress: model.ChannelState, now: datetime.datetime):
+        channel_id = progress.channel_id
+        # 集計の順番を待っている間に変更や削除がされていることがあるので読み直す。
+        # 予定時刻が変わっていれば次の集計に任せ、間隔と時刻だけの変更なら新しい値で集計する。
+        result = await asyncio.to_thread(self.storage.get_progress, channel_id=channel_id)
+        if result is None or result[2] != progress.timestamp:
+            return
+        progress.interval = result[0]
+        progress.time = result[1].replace(tzinfo=model.ZONE_UTC)
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            # キャッシュにないだけのこともある(サーバーが一時的に利用できないなど)ので、
+            # 準備完了後にAPIでも見つからなかったときだけ、channelが削除されたとみなしてprogressを削除する。
+            if not self.bot.is_ready():
+                return
+            try:
+                await self.bot.fetch_channel(channel_id)
+            except (discord.NotFound, discord.Forbidden):
+                await asyncio.to_thread(self.storage.delete_progress, channel_id=channel_id)
+            except discord.HTTPException as e:
+                print('failed to fetch channel {}: {!r}'.format(channel_id, e))
+            return
+        await self.ensure_members(channel.guild)
+
+        # progressに参加しているかつchannelに所属しているmemberを取得
+        rows = await asyncio.to_thread(self.storage.list_members, channel_id=channel_id)
+        state = model.TallyState.build(channel=progress, members=channel.members, rows=rows, bot_id=self.bot.user.id)
+        participants = state.participants
+        print('Channel name: {}'.format(channel.name))
+        print('Member name: {}'.format([participant.member.name for participant in participants.values()]))
+
+        embeds = []
+        # 前回と今回の期間内の進捗報告を取得
+        state.prev_window = model.ReportWindow(
+            start=progress.prev_prev_timestamp, end=progress.prev_timestamp,
+            reports=await asyncio.to_thread(self.storage.list_reports, channel_id=channel_id,
+                                            start=progress.prev_prev_timestamp, end=progress.prev_timestamp)
+        )
+        state.current_window = model.ReportWindow(
+            start=progress.prev_timestamp, end=progress.timestamp,
+            reports=await asyncio.to_thread(self.storage.list_reports, channel_id=channel_id,
+                                            start=progress.prev_timestamp, end=progress.timestamp)
+        )
+        messages: Optional[dict[int, Optional[discord.Message]]] = None
+        message_ids = {message_id for message_id, _ in state.prev_window.reports + state.current_window.reports}
+        if HISTORY_PREFETCH and len(message_ids) >= HISTORY_PREFETCH_MIN_REPORTS:
+            messages = await self.prefetch_messages(channel=channel, message_ids=message_ids)
+        # 前回のreportの検証
+        for message_id, user_id in state.prev_window.reports:
+            participant = participants.get(user_id)
+            message = await self.fetch_report(channel=channel, message_id=message_id, messages=messages)
+            if message is None:
+                if participant is not None:
+                    participant.deleted = True
                 continue
-
-            # progressに登録されているメンバーを取得
-            with self.database_connector.cursor() as cur:
-                cur.execute(
-                    'SELECT user_id FROM progress_members WHERE channel_id = %s',
-                    (channel_id,)
-                )
-                user_ids = cur.fetchall()
-                self.database_connector.commit()
-
-            print(user_ids)
-            print('Channel name: {}'.format(channel.name))
-            # progressに参加しているかつchannelに所属しているmemberを取得
-            members = [member for member in channel.members if
-                       member.id in [user_id[0] for user_id in user_ids] and member.id is not self.bot.user.id]
-            print('Member name: {}'.format([member.name for member in members]))
-
-            embeds = []
-            # 前回のreportの検証
-            approved: dict[int, int] = {member.id: 0 for member in members}
-            denied: dict[int, int] = {member.id: 0 for member in members}
-            deleted: list[int] = []
-            # 前回の期間内の進捗報告を取得
-            with self.database_connector.cursor() as cur:
-                cur.execute(
-                    'SELECT message_id, user_id FROM progress_reports'
-                    ' WHERE channel_id = %s AND %s <= timestamp AND timestamp < %s',
-                    (channel_id, prev_prev_timestamp, prev_timestamp)
-                )
-                results = cur.fetchall()
-                self.database_connector.commit()
-            # 取得した進捗報告を集計
-            for message_id, user_id in results:
-                try:
-                    message = await channel.fetch_message(message_id)
-                except discord.NotFound:
-                    deleted.append(user_id)
-                    continue
-                else:
-                    if user_id in [member.id for member in members]:
-                        reactions = [
-                            reaction for reaction in message.reactions if type(
-                                reaction.emoji) == str and reaction.emoji == THINKING_FACE.text]
-                        if len(reactions) == 1:
-                            if reactions[0].count - 1 <= len(members) / 2:
-                                approved[user_id] += 1
-                                embed_dict = message.embeds[0].to_dict()
-                                embed_dict['thumbnail'] = {'url': CHECK_MARK_BUTTON.url}
-                                embed_dict['color'] = discord.Colour.green().value
-                                await message.edit(embed=discord.Embed.from_dict(embed_dict))
-                            else:
-                                denied[user_id] += 1
-                                embed_dict = message.embeds[0].to_dict()
-                                embed_dict['thumbnail'] = {'url': CROSS_MARK.url}
-                                embed_dict['color'] = discord.Colour.red().value
-                                await message.edit(embed=discord.Embed.from_dict(embed_dict))
-                        else:
-                            raise ValueError
-            with self.database_connector.cursor() as cur:
-                for member in members:
-                    cur.execute(
-                        'SELECT streak FROM progress_members WHERE channel_id = %s AND user_id = %s',
-                        (channel_id, member.id)
-                    )
-                    result = cur.fetchone()
-                    if result is None:
-                        continue
-                    else:
-                        streak, = result
-                    if approved[member.id] > 0:
-                        # 承認された進捗報告があったとき
-                        streak = max(streak + 1, 1)
-                        cur.execute(
-                            'UPDATE progress_members SET score = score + %s, total = total + %s, streak = %s,'
-                            ' denied = denied + %s WHERE channel_id = %s AND user_id = %s', (
-                                calc_score(approved[member.id], denied[member.id], streak), approved[member.id],
-                                streak, denied[member.id], channel_id, member.id
-                            )
-                        )
-                        self.database_connector.commit()
-                    else:
-                        if denied[member.id] > 0:
-                            # 承認された報告がなく、かつ却下された進捗報告があったとき
-                            streak = min(streak - 1, -1)
-                            cur.execute(
-                                'UPDATE progress_members SET score = score + %s, streak = %s, denied = denied + %s'
-                                ' WHERE channel_id = %s AND user_id = %s', (
-                                    calc_score(0, denied[member.id], streak), streak, denied[member.id], channel_id,
-                                    member.id
-                                )
-                            )
-                            self.database_connector.commit()
-                        else:
-                            # 進捗報告がなかった時
-                            if member.id in deleted:
-                                # 進捗報告が削除されていた時
-                                streak = min(streak - 1, -1)
-                                cur.execute(
-                                    'UPDATE progress_members SET score = score + %s, streak = %s, escape = escape + 1'
-                                    ' WHERE channel_id + %s AND user_id = %s', (
-                                          calc_score(0, 0, streak), streak, channel_id, member.id
-                                    )
-                                )
-                                self.database_connector.commit()
-                            else:
-                                # 進捗報告がなかったとき 前日の時点で集計済み
-                                self.database_connector.commit()
-            print('approved')
-            print(approved)
-            print('denied')
-            print(denied)
-            if 0 < max(approved.values()):
-                names = ''
-                for member in members:
-                    if approved[member.id] > 0:
-                        if names == '':
-                            names = member.name
-                        else:
-                            names = '{0}, {1}'.format(names, member.name)
-                embed = discord.Embed(
-                    title='進捗報告承認!!', description=names, colour=discord.Colour.green()
-                )
-                embed.set_thumbnail(url=PARTY_POPPER.url)
-                embed.set_footer(text='{0}から{1}まで'.format(
-                    prev_prev_timestamp.astimezone(tz=ZONE_TOKYO).strftime('%Y年%m月%d日%H時%M分'),
-                    prev_timestamp.astimezone(tz=ZONE_TOKYO).strftime('%Y年%m月%d日%H時%M分')
-                ))
-                embeds.append(embed)
-
-            if 0 < max(denied.values()):
-                names = ''
-                for member in members:
-                    if denied[member.id] > 0:
-                        if names == '':
-                            names = member.name
-                        else:
-                            names = '{0}, {1}'.format(names, member.name)
-                embed = discord.Embed(
-                    title='進捗報告却下', description=names, colour=discord.Colour.red()
-                )
-                embed.set_thumbnail(url=INNOCENT.url)
-                embed.set_footer(text='{0}から{1}まで'.format(
-                    prev_prev_timestamp.astimezone(tz=ZONE_TOKYO).strftime('%Y年%m月%d日%H時%M分'),
-                    prev_timestamp.astimezone(tz=ZONE_TOKYO).strftime('%Y年%m月%d日%H時%M分')
-                ))
-                embeds.append(embed)
-
-            # 今回のreportの検証
-            reports: dict[int, int] = {member.id: 0 for member in members}
-            with self.database_connector.cursor() as cur:
-                cur.execute(
-                    'SELECT message_id, user_id FROM progress_reports '
-                    'WHERE channel_id = %s AND %s <= timestamp AND timestamp < %s',
-                    (channel_id, prev_timestamp, timestamp)
-                )
-                results = cur.fetchall()
-                self.database_connector.commit()
-            print(len(results))
-            print(channel_id)
-            for message_id, user_id in results:
-                try:
-                    message = await channel.fetch_message(message_id)
-                except discord.NotFound:
-                    print('Not Found')
-                    continue
-                else:
-                    if user_id in [member.id for member in members]:
-                        reports[user_id] += 1
-
-            next_timestamp = calc_nearest_datetime(now, _time.replace(tzinfo=ZONE_UTC)) + interval
-
-            # 進捗催促
-            print(reports)
-            if 0 in reports.values():
-                mentions = ''
-                with self.database_connector.cursor() as cur:
-                    for member in [member for member in members if reports[member.id] == 0]:
-                        mentions = '{0} {1}'.format(mentions, member.name)
-                        cur.execute(
-                            'SELECT streak FROM progress_members WHERE channel_id = %s AND user_id = %s', (
-                                channel_id, member.id
-                            )
-                        )
-                        streak, = cur.fetchone()
-                        streak = min(streak - 1, -1)
-                        cur.execute(
-                            'UPDATE progress_members SET score = score + %s, streak = %s, escape = escape + 1'
-                            ' WHERE channel_id = %s AND user_id = %s', (
-                                calc_score(0, 0, streak), streak, channel_id, member.id
-                            )
-                        )
-                embed = discord.Embed(title='進捗どうですか??', description=mentions, colour=discord.Colour.orange())
-                embed.set_footer(
-                    text='次回は{}です。'.format(next_timestamp.astimezone(tz=ZONE_TOKYO).strftime('%Y年%m月%d日%H時%M分')))
-                embed.set_thumbnail(url=THINKING_FACE.url)
-                embeds.append(embed)
+            if participant is None:
+                continue
+            reactions = [
+                reaction for reaction in message.reactions if type(
+                    reaction.emoji) == str and reaction.emoji == THINKING_FACE.text]
+            if len(reactions) != 1:
+                raise ValueError
+            embed_dict = message.embeds[0].to_dict()
+            if reactions[0].count - 1 <= len(participants) / 2:
+                participant.approved += 1
+                embed_dict['thumbnail'] = {'url': CHECK_MARK_BUTTON.url}
+                embed_dict['color'] = discord.Colour.green().value
             else:
-                embed = discord.Embed(title='全員報告済み!!', colour=discord.Colour.blue())
-                embed.set_thumbnail(url=PARTY_FACE.url)
-                embeds.append(embed)
-
-            # スコア　ランキング
-            with self.database_connector.cursor() as cur:
-                cur.execute(
-                    'SELECT user_id, score FROM progress_members WHERE channel_id = %s and user_id = ANY(%s) '
-                    'ORDER BY score DESC LIMIT 25', (channel_id, [member.id for member in members])
-                )
-                results = cur.fetchall()
-                self.database_connector.commit()
-            embed = discord.Embed(title='現在のスコア　ランキング', colour=discord.Colour.blurple())
-            for i in range(len(results)):
-                embed.add_field(
-                    name='{}位: {}'.format(i + 1, channel.guild.get_member(results[i][0]).name),
-                    value='{}'.format(results[i][1]),
-                    inline=False
-                )
+                participant.denied += 1
+                embed_dict['thumbnail'] = {'url': CROSS_MARK.url}
+                embed_dict['color'] = discord.Colour.red().value
+            await message.edit(embed=discord.Embed.from_dict(embed_dict))
+        # メンバーの更新はここでは書き込まず、送信後にまとめて反映する。
+        updates = [(participant.id, participant.review()) for participant in participants.values()]
+        updates = [(user_id, update) for user_id, update in updates if update is not None]
+
+        footer = '{0}から{1}まで'.format(
+            progress.prev_prev_timestamp.astimezone(tz=ZONE_TOKYO).strftime('%Y年%m月%d日%H時%M分'),
+            progress.prev_timestamp.astimezone(tz=ZONE_TOKYO).strftime('%Y年%m月%d日%H時%M分')
+        )
+        approved = state.approved()
+        if approved:
+            embed = discord.Embed(
+                title='進捗報告承認!!', description=', '.join(participant.member.name for participant in approved),
+                colour=discord.Colour.green()
+            )
+            embed.set_thumbnail(url=PARTY_POPPER.url)
+            embed.set_footer(text=footer)
             embeds.append(embed)
 
-            await channel.send(embeds=embeds)
+        denied = state.denied()
+        if denied:
+            embed = discord.Embed(
+                title='進捗報告却下', description=', '.join(participant.member.name for participant in denied),
+                colour=discord.Colour.red()
+            )
+            embed.set_thumbnail(url=INNOCENT.url)
+            embed.set_footer(text=footer)
+            embeds.append(embed)
 
-            # 古いreportの削除
-            # channelの情報の更新
-            with self.database_connector.cursor() as cur:
-                cur.execute(
-                    'DELETE FROM progress_reports WHERE timestamp < %s', (prev_prev_timestamp,)
-                )
-                cur.execute(
-                    'UPDATE progress SET timestamp = %s, prev_timestamp = %s, prev_prev_timestamp = %s '
-                    'WHERE channel_id = %s',
-                    (next_timestamp, timestamp, prev_timestamp, channel_id)
-                )
-                self.database_connector.commit()
+        # 今回のreportの検証
+        for message_id, user_id in state.current_window.reports:
+            message = await self.fetch_report(channel=channel, message_id=message_id, messages=messages)
+            if message is None:
+                print('Not Found')
+                continue
+            participant = participants.get(user_id)
+            if participant is not None:
+                participant.reports += 1
+
+        next_timestamp = calc_nearest_datetime(now, progress.time) + progress.interval
+
+        # 進捗催促
+        unreported = state.unreported()
+        if unreported:
+            mentions = ''
+            for participant in unreported:
+                mentions = '{0} {1}'.format(mentions, participant.member.name)
+            updates += [(participant.id, participant.nag()) for participant in unreported]
+            embed = discord.Embed(title='進捗どうですか??', description=mentions, colour=discord.Colour.orange())
+            embed.set_footer(
+                text='次回は{}です。'.format(next_timestamp.astimezone(tz=ZONE_TOKYO).strftime('%Y年%m月%d日%H時%M分')))
+            embed.set_thumbnail(url=THINKING_FACE.url)
+            embeds.append(embed)
+        else:
+            embed = discord.Embed(title='全員報告済み!!', colour=discord.Colour.blue())
+            embed.set_thumbnail(url=PARTY_FACE.url)
+            embeds.append(embed)
+
+        # スコア　ランキング
+        ranking = state.ranking()
+        embed = discord.Embed(title='現在のスコア　ランキング', colour=discord.Colour.blurple())
+        for i, participant in enumerate(ranking):
+            embed.add_field(
+                name='{}位: {}'.format(i + 1, participant.member.name),
+                value='{}'.format(participant.score),
+                inline=False
+            )
+        files = []
+        if len(ranking) > 0:
+            # 集計ごとにスコアが変わるので、今回の予定時刻をデータのバージョンとする。
+            image = await self.chart_renderer.render(
+                ('ranking', channel_id), progress.timestamp, chart.render_ranking,
+                [participant.member.name for participant in ranking], [participant.score for participant in ranking]
+            )
+            if image is not None:
+                files.append(discord.File(io.BytesIO(image), filename='ranking.png'))
+                embed.set_image(url='attachment://ranking.png')
+        embeds.append(embed)
+
+        await channel.send(embeds=embeds, files=files)
+
+        # メンバーの更新とchannelの情報の更新、スコアの履歴の記録を1つのトランザクションで反映する。
+        # 送信前に中断されたときは何も反映されず、次の集計でやり直す。
+        if not await asyncio.to_thread(self.storage.finish_tally, channel_id=channel_id, updates=updates,
+                                       user_ids=list(participants), timestamp=next_timestamp,
+                                       prev_timestamp=progress.timestamp,
+                                       prev_prev_timestamp=progress.prev_timestamp, retention=HISTORY_RETENTION):
+            print('progress of {} was changed during the tally.'.format(channel_id))
 
 
 async def setup(bot: discord.ext.commands.Bot):
@@ -0,0 +1,65 @@
+import collections
+import datetime
+import gc
+import os
+import tracemalloc
+from typing import List, Optional
+
+import discord
+
+MEMWATCH_ENABLED = os.getenv('PROGRESS_TRACEMALLOC', '0') == '1'
+MEMWATCH_FRAMES = 1
+MEMWATCH_SAMPLES = 64
+# この回数続けてメモリが増え続けたら警告する。
+GROWTH_WARNING_SAMPLES = 8
+
+
+class MemorySample:
+    def __init__(self, timestamp: datetime.datetime, traced: int, runners: int, views: int):
+        self.timestamp = timestamp
+        self.traced = traced
+        self.runners = runners
+        self.views = views
+
+
+# 長時間の稼働でRunnerやviewやキャッシュが増え続けていないかをtracemallocで監視する。
+class MemoryWatch:
+    def __init__(self, enabled: bool = MEMWATCH_ENABLED):
+        self.enabled = enabled
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.samples: collections.deque[MemorySample] = collections.deque(maxlen=MEMWATCH_SAMPLES)
+
+    def start(self):
+        if not self.enabled:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(MEMWATCH_FRAMES)
+        self.baseline = tracemalloc.take_snapshot()
+
+    def stop(self):
+        if self.enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.baseline = None
+
+    def sample(self, runners: int):
+        if self.baseline is None:
+            return
+        traced, _ = tracemalloc.get_traced_memory()
+        views = sum(1 for obj in gc.get_objects() if isinstance(obj, discord.ui.View))
+        self.samples.append(MemorySample(timestamp=datetime.datetime.now(tz=datetime.timezone.utc), traced=traced,
+                                         runners=runners, views=views))
+        if self.growing():
+            print('memory keeps growing: {} bytes traced, {} runners, {} views.'.format(traced, runners, views))
+
+    def growing(self) -> bool:
+        if len(self.samples) < GROWTH_WARNING_SAMPLES:
+            return False
+        samples = list(self.samples)[-GROWTH_WARNING_SAMPLES:]
+        return all(prev.traced < sample.traced for prev, sample in zip(samples, samples[1:]))
+
+    # 起動時からの増加量が大きい行
+    def top_growth(self, limit: int = 5) -> List[str]:
+        if self.baseline is None:
+            return []
+        stats = tracemalloc.take_snapshot().compare_to(self.baseline, 'lineno')
+        return [str(stat) for stat in stats[:limit]]
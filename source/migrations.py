@@ -0,0 +1,76 @@
+from typing import Callable, Dict, List, Tuple, Union
+
+from . import partitions
+
+# pg_advisory_xact_lockに使うキー。複数のプロセスが同時に起動してもマイグレーションは1回だけ実行される。
+LOCK_ID = 0x70726f67
+# (バージョン, 実行するSQLまたはcursorを受け取る関数)。追加するときは両方の方言の末尾にバージョンを1つ増やして追加する。
+MIGRATIONS: Dict[str, List[Tuple[int, List[Union[str, Callable]]]]] = {
+    'postgresql': [
+        (1, [
+            'CREATE TABLE IF NOT EXISTS progress (channel_id BIGINT, interval INTERVAL, time TIME,'
+            ' timestamp TIMESTAMPTZ, prev_timestamp TIMESTAMPTZ, prev_prev_timestamp TIMESTAMPTZ,'
+            ' PRIMARY KEY (channel_id))',
+            'CREATE TABLE IF NOT EXISTS progress_members (channel_id BIGINT, user_id BIGINT, score INTEGER,'
+            ' total INTEGER, streak INTEGER, escape INTEGER, denied INTEGER, PRIMARY KEY (channel_id, user_id))',
+            'CREATE TABLE IF NOT EXISTS progress_reports (channel_id BIGINT, user_id BIGINT, message_id BIGINT,'
+            ' timestamp TIMESTAMPTZ, PRIMARY KEY (channel_id, user_id, message_id))',
+            'CREATE TABLE IF NOT EXISTS progress_history (channel_id BIGINT, user_id BIGINT,'
+            ' timestamp TIMESTAMPTZ, score INTEGER, streak INTEGER, PRIMARY KEY (channel_id, user_id, timestamp))'
+        ]),
+        # progress_reportsを時刻で分割し、古い報告は分割ごと削除できるようにする。
+        (2, [
+            'ALTER TABLE progress_reports RENAME TO progress_reports_unpartitioned',
+            'ALTER INDEX progress_reports_pkey RENAME TO progress_reports_unpartitioned_pkey',
+            'CREATE TABLE progress_reports (channel_id BIGINT, user_id BIGINT, message_id BIGINT,'
+            ' timestamp TIMESTAMPTZ NOT NULL, PRIMARY KEY (channel_id, user_id, message_id, timestamp))'
+            ' PARTITION BY RANGE (timestamp)',
+            'CREATE TABLE {} PARTITION OF progress_reports DEFAULT'.format(partitions.DEFAULT_PARTITION),
+            partitions.create_partitions_for_unpartitioned,
+            'INSERT INTO progress_reports (channel_id, user_id, message_id, timestamp)'
+            ' SELECT channel_id, user_id, message_id, timestamp FROM progress_reports_unpartitioned'
+            ' WHERE timestamp IS NOT NULL',
+            'DROP TABLE progress_reports_unpartitioned'
+        ])
+    ],
+    'sqlite': [
+        (1, [
+            'CREATE TABLE IF NOT EXISTS progress (channel_id INTEGER, interval REAL, time TEXT,'
+            ' timestamp REAL, prev_timestamp REAL, prev_prev_timestamp REAL, PRIMARY KEY (channel_id))',
+            'CREATE TABLE IF NOT EXISTS progress_members (channel_id INTEGER, user_id INTEGER, score INTEGER,'
+            ' total INTEGER, streak INTEGER, "escape" INTEGER, denied INTEGER, PRIMARY KEY (channel_id, user_id))',
+            'CREATE TABLE IF NOT EXISTS progress_reports (channel_id INTEGER, user_id INTEGER, message_id INTEGER,'
+            ' timestamp REAL, PRIMARY KEY (channel_id, user_id, message_id))',
+            'CREATE INDEX IF NOT EXISTS progress_reports_channel_timestamp'
+            ' ON progress_reports (channel_id, timestamp)',
+            'CREATE TABLE IF NOT EXISTS progress_history (channel_id INTEGER, user_id INTEGER,'
+            ' timestamp REAL, score INTEGER, streak INTEGER, PRIMARY KEY (channel_id, user_id, timestamp))'
+        ]),
+        # SQLiteは分割できないので、古い報告はDELETEで削除する。
+        (2, [])
+    ]
+}
+
+
+# 未適用のマイグレーションを1つのトランザクションで適用し、適用後のバージョンを返す。
+def migrate(storage) -> int:
+    with storage.transaction() as cur:
+        if storage.dialect == 'postgresql':
+            cur.execute('SELECT pg_advisory_xact_lock({})'.format(LOCK_ID))
+        cur.execute(
+            'CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY,'
+            ' applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP)'
+        )
+        cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+        version, = cur.fetchone()
+        for _version, statements in MIGRATIONS[storage.dialect]:
+            if _version <= version:
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(cur)
+                else:
+                    cur.execute(statement)
+            cur.execute('INSERT INTO schema_migrations (version) VALUES ({})'.format(int(_version)))
+            version = _version
+    return version
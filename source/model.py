@@ -0,0 +1,113 @@
+import datetime
+from typing import Dict, Iterable, List, Optional
+
+import discord
+
+ZONE_UTC = datetime.timezone.utc
+
+
+def calc_score(approved: int, denied: int, streak: int):
+    return approved * 100 - denied * 50 + streak * 10
+
+
+# progressテーブルの1行
+class ChannelState:
+    __slots__ = ('channel_id', 'interval', 'time', 'timestamp', 'prev_timestamp', 'prev_prev_timestamp')
+
+    def __init__(self, channel_id: int, interval: datetime.timedelta, _time: datetime.time,
+                 timestamp: datetime.datetime, prev_timestamp: datetime.datetime,
+                 prev_prev_timestamp: datetime.datetime):
+        self.channel_id = channel_id
+        self.interval = interval
+        self.time = _time.replace(tzinfo=ZONE_UTC)
+        self.timestamp = timestamp.astimezone(tz=ZONE_UTC)
+        self.prev_timestamp = prev_timestamp.astimezone(tz=ZONE_UTC)
+        self.prev_prev_timestamp = prev_prev_timestamp.astimezone(tz=ZONE_UTC)
+
+
+# 進捗報告を集計する期間と、その期間内の報告の(message_id, user_id)
+class ReportWindow:
+    __slots__ = ('start', 'end', 'reports')
+
+    def __init__(self, start: datetime.datetime, end: datetime.datetime, reports: List[tuple]):
+        self.start = start
+        self.end = end
+        self.reports = reports
+
+
+# 集計中のメンバー1人分の状態。scoreとstreakは更新内容を反映した値を持つ。
+class Participant:
+    __slots__ = ('member', 'score', 'streak', 'approved', 'denied', 'reports', 'deleted')
+
+    def __init__(self, member: discord.Member, score: int, streak: int):
+        self.member = member
+        self.score = score
+        self.streak = streak
+        self.approved = 0
+        self.denied = 0
+        self.reports = 0
+        self.deleted = False
+
+    @property
+    def id(self) -> int:
+        return self.member.id
+
+    # 前回の報告の検証結果を反映し、progress_membersの更新内容を返す。報告がなかったときは前回の時点で集計済み。
+    def review(self) -> Optional[dict]:
+        if self.approved > 0:
+            # 承認された進捗報告があったとき
+            self.streak = max(self.streak + 1, 1)
+            update = {'score': calc_score(self.approved, self.denied, self.streak), 'streak': self.streak,
+                      'total': self.approved, 'denied': self.denied}
+        elif self.denied > 0:
+            # 承認された報告がなく、かつ却下された進捗報告があったとき
+            self.streak = min(self.streak - 1, -1)
+            update = {'score': calc_score(0, self.denied, self.streak), 'streak': self.streak, 'denied': self.denied}
+        elif self.deleted:
+            # 進捗報告が削除されていた時
+            self.streak = min(self.streak - 1, -1)
+            update = {'score': calc_score(0, 0, self.streak), 'streak': self.streak, 'escape': 1}
+        else:
+            return None
+        self.score += update['score']
+        return update
+
+    # 今回の報告がなかったときの更新内容を返す。
+    def nag(self) -> dict:
+        self.streak = min(self.streak - 1, -1)
+        update = {'score': calc_score(0, 0, self.streak), 'streak': self.streak, 'escape': 1}
+        self.score += update['score']
+        return update
+
+
+# 1つのチャンネルの集計に使う状態
+class TallyState:
+    __slots__ = ('channel', 'participants', 'prev_window', 'current_window')
+
+    def __init__(self, channel: ChannelState, participants: Dict[int, Participant]):
+        self.channel = channel
+        self.participants = participants
+        self.prev_window: Optional[ReportWindow] = None
+        self.current_window: Optional[ReportWindow] = None
+
+    # progressに参加しているかつchannelに所属しているmemberから作る。rowsは(user_id, score, streak)。
+    @classmethod
+    def build(cls, channel: ChannelState, members: Iterable[discord.Member], rows: Iterable[tuple],
+              bot_id: int) -> 'TallyState':
+        rows = {user_id: (score, streak) for user_id, score, streak in rows}
+        return cls(channel=channel, participants={
+            member.id: Participant(member, *rows[member.id]) for member in members
+            if member.id in rows and member.id != bot_id
+        })
+
+    def approved(self) -> List[Participant]:
+        return [participant for participant in self.participants.values() if participant.approved > 0]
+
+    def denied(self) -> List[Participant]:
+        return [participant for participant in self.participants.values() if participant.denied > 0]
+
+    def unreported(self) -> List[Participant]:
+        return [participant for participant in self.participants.values() if participant.reports == 0]
+
+    def ranking(self, limit: int = 25) -> List[Participant]:
+        return sorted(self.participants.values(), key=lambda participant: participant.score, reverse=True)[:limit]
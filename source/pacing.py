@@ -0,0 +1,79 @@
+import asyncio
+import collections
+import datetime
+import os
+import random
+import time
+from typing import Awaitable, Callable, List
+
+from . import model
+
+# 同じ時刻に集計するchannelが多いとき、DBとDiscordへのリクエストが集中しないように集計の開始をずらす。
+# 開始の間隔はTALLY_RATE件/秒までに抑え、TALLY_WINDOW秒はその上限とする。多すぎるときだけwindowに詰めて並べる。
+# 時刻は5分刻みでしか選べないので、windowは次の時刻と重ならないように5分より短くする。
+TALLY_RATE = float(os.getenv('PROGRESS_TALLY_RATE', '2'))
+TALLY_WINDOW = min(float(os.getenv('PROGRESS_TALLY_WINDOW', '120')), 240.0)
+TALLY_JITTER = float(os.getenv('PROGRESS_TALLY_JITTER', '3'))
+# これ以下の数のchannelはずらさずにすぐ集計する。
+TALLY_BURST = 5
+TICK_SAMPLES = 64
+
+
+class TickStats:
+    def __init__(self, timestamp: datetime.datetime, due: int, window: float, max_lateness: float, duration: float,
+                 failed: List[int]):
+        self.timestamp = timestamp
+        self.due = due
+        self.window = window
+        self.max_lateness = max_lateness
+        self.duration = duration
+        # 集計に失敗したchannel_id
+        self.failed = failed
+
+
+# 予定時刻が古いchannelから順に、最初のburst件はすぐに、残りは1/rate秒ずつ(windowに収まらなければ詰めて)並べ、少しだけ揺らす。
+# 揺らす幅は間隔の半分までに抑え、順番が入れ替わったりwindowを越えたりしないようにする。
+def spread_offsets(count: int, rate: float = TALLY_RATE, window: float = TALLY_WINDOW, jitter: float = TALLY_JITTER,
+                   burst: int = TALLY_BURST) -> List[float]:
+    if count <= burst or window <= 0 or rate <= 0:
+        return [0.0] * count
+    gap = min(1 / rate, window / (count - burst))
+    bound = min(jitter, gap / 2)
+    return [0.0] * burst + [gap * (i + 1) - random.uniform(0, bound) for i in range(count - burst)]
+
+
+class TallyPacer:
+    def __init__(self, rate: float = TALLY_RATE, window: float = TALLY_WINDOW, jitter: float = TALLY_JITTER,
+                 burst: int = TALLY_BURST):
+        self.rate = rate
+        self.window = window
+        self.jitter = jitter
+        self.burst = burst
+        self.ticks: collections.deque[TickStats] = collections.deque(maxlen=TICK_SAMPLES)
+
+    # due(予定時刻を過ぎたchannel)を順に集計し、この回の統計を記録する。
+    # 失敗したchannelは進まないので毎回最初に集計されるが、他のchannelの集計は止めずに続ける。
+    async def run(self, due: List[model.ChannelState],
+                  tally: Callable[[model.ChannelState], Awaitable[None]]) -> TickStats:
+        due = sorted(due, key=lambda progress: progress.timestamp)
+        offsets = spread_offsets(len(due), rate=self.rate, window=self.window, jitter=self.jitter, burst=self.burst)
+        start = time.monotonic()
+        max_lateness = 0.0
+        failed = []
+        for progress, offset in zip(due, offsets):
+            delay = start + offset - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lateness = (datetime.datetime.now(tz=model.ZONE_UTC) - progress.timestamp).total_seconds()
+            max_lateness = max(max_lateness, lateness)
+            try:
+                await tally(progress)
+            except Exception as e:
+                print('failed to tally channel {}: {!r}'.format(progress.channel_id, e))
+                failed.append(progress.channel_id)
+        stats = TickStats(timestamp=datetime.datetime.now(tz=model.ZONE_UTC), due=len(due),
+                          window=offsets[-1] if offsets else 0.0, max_lateness=max_lateness,
+                          duration=time.monotonic() - start, failed=failed)
+        if stats.due > 0:
+            self.ticks.append(stats)
+        return stats
@@ -0,0 +1,93 @@
+import datetime
+import gzip
+import os
+from typing import List, Optional, Tuple
+
+# PostgreSQLのprogress_reportsを週ごとに分割する。SQLiteでは使わない。
+ZONE_UTC = datetime.timezone.utc
+PARTITION_SPAN = datetime.timedelta(days=7)
+PARTITIONS_AHEAD = 4
+PARTITION_PREFIX = 'progress_reports_p'
+DEFAULT_PARTITION = 'progress_reports_default'
+# 設定されていれば、削除する分割をgzipで圧縮したCSVとしてこのディレクトリに保存する。
+ARCHIVE_DIR = os.getenv('PROGRESS_REPORT_ARCHIVE_DIR')
+
+
+# 週の始まり(月曜日 0時 UTC)
+def partition_start(timestamp: datetime.datetime) -> datetime.datetime:
+    date = timestamp.astimezone(tz=ZONE_UTC).date()
+    return datetime.datetime.combine(date=date - datetime.timedelta(days=date.weekday()), time=datetime.time(),
+                                     tzinfo=ZONE_UTC)
+
+
+def partition_name(start: datetime.datetime) -> str:
+    return '{}{}'.format(PARTITION_PREFIX, start.strftime('%Y%m%d'))
+
+
+# startからendまでを含む分割を作る。
+# defaultの分割に同じ期間の行が入っているとそのままでは作れないので、別のテーブルとして作って行を移してから繋ぐ。
+def create_partitions(cur, start: datetime.datetime, end: datetime.datetime):
+    _start = partition_start(start)
+    while _start <= end:
+        name = partition_name(_start)
+        cur.execute('SELECT to_regclass(%s)', (name,))
+        if cur.fetchone()[0] is None:
+            cur.execute('CREATE TABLE {} (LIKE progress_reports)'.format(name))
+            cur.execute(
+                'WITH moved AS (DELETE FROM {} WHERE %s <= timestamp AND timestamp < %s RETURNING *)'
+                ' INSERT INTO {} SELECT * FROM moved'.format(DEFAULT_PARTITION, name),
+                (_start, _start + PARTITION_SPAN)
+            )
+            cur.execute(
+                'ALTER TABLE progress_reports ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)'.format(name),
+                (_start, _start + PARTITION_SPAN)
+            )
+        _start += PARTITION_SPAN
+
+
+def create_future_partitions(cur, now: datetime.datetime):
+    create_partitions(cur, now, now + PARTITION_SPAN * PARTITIONS_AHEAD)
+
+
+# (名前, 開始時刻)の一覧。名前は作成時に開始時刻から付けているのでそこから読み取る。
+def list_partitions(cur) -> List[Tuple[str, datetime.datetime]]:
+    cur.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid"
+        " WHERE i.inhparent = 'progress_reports'::regclass"
+    )
+    partitions = []
+    for name, in cur.fetchall():
+        if not name.startswith(PARTITION_PREFIX):
+            continue
+        start = datetime.datetime.strptime(name[len(PARTITION_PREFIX):], '%Y%m%d').replace(tzinfo=ZONE_UTC)
+        partitions.append((name, start))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def archive_partition(cur, name: str, archive_dir: str):
+    os.makedirs(archive_dir, exist_ok=True)
+    with gzip.open(os.path.join(archive_dir, '{}.csv.gz'.format(name)), 'wb') as file:
+        cur.copy_expert('COPY {} TO STDOUT WITH CSV HEADER'.format(name), file)
+
+
+# horizonより前だけを含む分割を切り離して削除し、削除した分割の名前を返す。
+def drop_expired_partitions(cur, horizon: datetime.datetime, archive_dir: Optional[str] = None) -> List[str]:
+    dropped = []
+    for name, start in list_partitions(cur):
+        if horizon < start + PARTITION_SPAN:
+            continue
+        if archive_dir is not None:
+            archive_partition(cur, name, archive_dir)
+        cur.execute('ALTER TABLE progress_reports DETACH PARTITION {}'.format(name))
+        cur.execute('DROP TABLE {}'.format(name))
+        dropped.append(name)
+    cur.execute('DELETE FROM {} WHERE timestamp < %s'.format(DEFAULT_PARTITION), (horizon,))
+    return dropped
+
+
+# 分割前のprogress_reportsにある行をすべて収められるように分割を作る。マイグレーションから呼ばれる。
+def create_partitions_for_unpartitioned(cur):
+    cur.execute('SELECT MIN(timestamp) FROM progress_reports_unpartitioned')
+    oldest, = cur.fetchone()
+    now = datetime.datetime.now(tz=ZONE_UTC)
+    create_partitions(cur, now if oldest is None else min(oldest, now), now + PARTITION_SPAN * PARTITIONS_AHEAD)
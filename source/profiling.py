@@ -0,0 +1,56 @@
+import contextlib
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import time
+
+PROFILE_DIR = os.getenv('PROGRESS_PROFILE_DIR', 'profiles')
+TOP_FUNCTIONS = 20
+KINDS = ('tally', 'interaction')
+
+
+# 指定した回数だけ集計やinteractionをcProfileで計測し、.profと上位の関数のまとめを保存する。
+# 計測しないときは回数を確認するだけなので、ほとんど負荷はかからない。
+class Profiler:
+    def __init__(self, directory: str = PROFILE_DIR):
+        self.directory = directory
+        self.remaining = {kind: 0 for kind in KINDS}
+        # cProfileは同時に1つしか有効にできない。
+        self.active = False
+
+    def arm(self, kind: str, count: int):
+        if kind not in self.remaining:
+            raise ValueError(kind)
+        self.remaining[kind] = max(count, 0)
+        print('profile next {} {} runs.'.format(count, kind))
+
+    @contextlib.asynccontextmanager
+    async def profile(self, kind: str, name: str):
+        if self.remaining[kind] == 0 or self.active:
+            yield
+            return
+        self.remaining[kind] -= 1
+        self.active = True
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.active = False
+            self.save(profile=profile, kind=kind, name=name, elapsed=time.perf_counter() - start)
+
+    def save(self, profile: cProfile.Profile, kind: str, name: str, elapsed: float):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{0}-{1}-{2}'.format(
+            kind, name, datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')))
+        profile.dump_stats(path + '.prof')
+        stream = io.StringIO()
+        stream.write('{0} {1}: {2:.3f}s\n'.format(kind, name, elapsed))
+        pstats.Stats(profile, stream=stream).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+        with open(path + '.txt', 'w', encoding='utf-8') as file:
+            file.write(stream.getvalue())
+        print('saved profile to {}.prof ({:.3f}s)'.format(path, elapsed))
@@ -0,0 +1,384 @@
+import contextlib
+import datetime
+import json
+import re
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from . import migrations, partitions
+
+ZONE_UTC = datetime.timezone.utc
+SQLITE_URL_PREFIX = 'sqlite:///'
+# 進捗報告は最長の間隔(7日)の2回分は必ず残す。
+REPORT_RETENTION_FLOOR = datetime.timedelta(days=14)
+# 頻繁に実行するSQL。%sをプレースホルダとし、{user_ids}はuser_idの配列との比較に方言ごとに置き換える。
+STATEMENTS: Dict[str, str] = {
+    'get_progress': 'SELECT interval, time, timestamp FROM progress WHERE channel_id = %s',
+    'list_progress': 'SELECT channel_id, interval, time, timestamp, prev_timestamp, prev_prev_timestamp FROM progress',
+    'list_progress_times': 'SELECT time FROM progress',
+    'find_progress': 'SELECT channel_id FROM progress WHERE channel_id = %s',
+    'insert_progress': 'INSERT INTO progress (channel_id, interval, time, timestamp, prev_timestamp,'
+                       ' prev_prev_timestamp) VALUES (%s, %s, %s, %s, %s, %s)',
+    'update_progress': 'UPDATE progress SET interval = %s, time = %s, timestamp = %s WHERE channel_id = %s',
+    'advance_progress': 'UPDATE progress SET timestamp = %s, prev_timestamp = %s, prev_prev_timestamp = %s'
+                        ' WHERE channel_id = %s AND timestamp = %s',
+    'delete_progress': 'DELETE FROM progress WHERE channel_id = %s',
+    'get_member': 'SELECT score, total, streak, "escape", denied FROM progress_members'
+                  ' WHERE channel_id = %s AND user_id = %s',
+    'list_members': 'SELECT user_id, score, streak FROM progress_members WHERE channel_id = %s',
+    'add_member': 'INSERT INTO progress_members (channel_id, user_id, total, streak, "escape", denied, score)'
+                  ' VALUES (%s, %s, 0, 0, 0, 0, 0)',
+    'remove_member': 'DELETE FROM progress_members WHERE channel_id = %s AND user_id = %s',
+    'update_member': 'UPDATE progress_members SET score = score + %s, total = total + %s, streak = %s,'
+                     ' "escape" = "escape" + %s, denied = denied + %s WHERE channel_id = %s AND user_id = %s',
+    'add_report': 'INSERT INTO progress_reports (channel_id, message_id, user_id, timestamp) VALUES (%s, %s, %s, %s)',
+    'list_reports': 'SELECT message_id, user_id FROM progress_reports'
+                    ' WHERE channel_id = %s AND %s <= timestamp AND timestamp < %s',
+    'delete_reports_before': 'DELETE FROM progress_reports WHERE timestamp < %s',
+    'report_horizon': 'SELECT MIN(prev_prev_timestamp) FROM progress',
+    'record_history': 'INSERT INTO progress_history (channel_id, user_id, timestamp, score, streak)'
+                      ' SELECT channel_id, user_id, CAST(%s AS TIMESTAMPTZ), score, streak FROM progress_members'
+                      ' WHERE channel_id = %s AND {user_ids} ON CONFLICT DO NOTHING',
+    'delete_history_before': 'DELETE FROM progress_history WHERE channel_id = %s AND timestamp < %s',
+    'list_history': 'SELECT timestamp, score, streak FROM progress_history WHERE channel_id = %s AND user_id = %s'
+                    ' ORDER BY timestamp'
+}
+
+
+class StatementStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        # 準備していない同じSQLの計画時間。Postgresでのみ計測する。
+        self.planning_ms: Optional[float] = None
+        # 汎用の計画を使った実行回数。PostgreSQL 14以降のpg_prepared_statementsから読む。
+        self.generic_plans: Optional[int] = None
+
+    # 計画を立てずに済んだのは汎用の計画を使った実行だけ。
+    @property
+    def saved_ms(self) -> Optional[float]:
+        if self.planning_ms is None:
+            return None
+        if self.generic_plans is None:
+            return self.upper_bound_ms
+        return self.planning_ms * self.generic_plans
+
+    # 回数がわからないとき。最初の5回は毎回計画を立て、それ以降はすべて汎用の計画を使ったとみなした上限。
+    # 汎用の計画のほうが高くつくと判断されたSQLはその後も毎回計画を立てるので、実際はこれより少ない。
+    @property
+    def upper_bound_ms(self) -> Optional[float]:
+        if self.planning_ms is None:
+            return None
+        return self.planning_ms * max(self.calls - 5, 0)
+
+
+# progress, progress_members, progress_reports, progress_historyへの操作をまとめたもの。
+# SQLはSTATEMENTSに名前をつけて登録し、方言ごとの差はサブクラスで吸収する。
+class Storage:
+    dialect: str = ''
+    USER_IDS = 'user_id = ANY(%s)'
+
+    def __init__(self, database_connector):
+        self.database_connector = database_connector
+        # 1つの接続を複数のスレッドから使うので、トランザクション単位で直列化する。
+        self.lock = threading.Lock()
+        self.statements = {name: sql.replace('{user_ids}', self.USER_IDS) for name, sql in STATEMENTS.items()}
+        self.stats = {name: StatementStats(name=name) for name in self.statements}
+
+    def close(self):
+        self.database_connector.close()
+
+    def migrate(self) -> int:
+        return migrations.migrate(self)
+
+    # 接続ごとにSTATEMENTSを準備する。
+    def prepare(self):
+        pass
+
+    # statsに載せる値のうち、データベースから読む必要があるものを更新する。
+    def refresh_stats(self):
+        pass
+
+    def begin(self, cur):
+        pass
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            cur = self.database_connector.cursor()
+            try:
+                self.begin(cur)
+                yield cur
+                self.database_connector.commit()
+            except BaseException:
+                self.database_connector.rollback()
+                raise
+            finally:
+                cur.close()
+
+    def execute(self, cur, sql: str, params: Sequence = ()):
+        cur.execute(sql, params)
+
+    def run(self, cur, name: str, params: Sequence = ()):
+        self.stats[name].calls += 1
+        self.execute(cur, self.statements[name], params)
+
+    def to_timestamp(self, value) -> datetime.datetime:
+        return value
+
+    def to_interval(self, value) -> datetime.timedelta:
+        return value
+
+    def to_time(self, value) -> datetime.time:
+        return value
+
+    # progress
+    def get_progress(self, channel_id: int) -> Optional[Tuple[datetime.timedelta, datetime.time, datetime.datetime]]:
+        with self.transaction() as cur:
+            self.run(cur, 'get_progress', (channel_id,))
+            result = cur.fetchone()
+        if result is None:
+            return None
+        interval, _time, timestamp = result
+        return self.to_interval(interval), self.to_time(_time), self.to_timestamp(timestamp)
+
+    def list_progress(self) -> List[tuple]:
+        with self.transaction() as cur:
+            self.run(cur, 'list_progress')
+            results = cur.fetchall()
+        return [(channel_id, self.to_interval(interval), self.to_time(_time), self.to_timestamp(timestamp),
+                 self.to_timestamp(prev_timestamp), self.to_timestamp(prev_prev_timestamp))
+                for channel_id, interval, _time, timestamp, prev_timestamp, prev_prev_timestamp in results]
+
+    def list_progress_times(self) -> List[datetime.time]:
+        with self.transaction() as cur:
+            self.run(cur, 'list_progress_times')
+            results = cur.fetchall()
+        return [self.to_time(_time) for _time, in results]
+
+    # 登録されていなければ追加し、登録済みなら間隔と時刻を変更する。
+    def save_progress(self, channel_id: int, interval: datetime.timedelta, _time: datetime.time,
+                      timestamp: datetime.datetime):
+        with self.transaction() as cur:
+            self.run(cur, 'find_progress', (channel_id,))
+            if cur.fetchone() is None:
+                self.run(cur, 'insert_progress', (channel_id, interval, _time, timestamp, timestamp - interval,
+                                                  timestamp - interval * 2))
+            else:
+                self.run(cur, 'update_progress', (interval, _time, timestamp, channel_id))
+
+    # 予定時刻がprev_timestampのままのときだけ進める。集計中に変更された予定時刻は上書きしない。
+    def advance_progress(self, channel_id: int, timestamp: datetime.datetime, prev_timestamp: datetime.datetime,
+                         prev_prev_timestamp: datetime.datetime):
+        with self.transaction() as cur:
+            self.run(cur, 'advance_progress', (timestamp, prev_timestamp, prev_prev_timestamp, channel_id,
+                                               prev_timestamp))
+
+    # 集計結果をまとめて反映する。メンバーの更新、予定時刻の更新、スコアの履歴を1つのトランザクションで行い、
+    # 予定時刻が集計中に変更されていたら何も反映せずFalseを返す。中断された集計が一部だけ反映されることはない。
+    def finish_tally(self, channel_id: int, updates: Iterable[Tuple[int, dict]], user_ids: Iterable[int],
+                     timestamp: datetime.datetime, prev_timestamp: datetime.datetime,
+                     prev_prev_timestamp: datetime.datetime, retention: datetime.timedelta) -> bool:
+        with self.transaction() as cur:
+            self.run(cur, 'advance_progress', (timestamp, prev_timestamp, prev_prev_timestamp, channel_id,
+                                               prev_timestamp))
+            if cur.rowcount != 1:
+                return False
+            self.apply_member_updates(cur, channel_id, updates)
+            self.run(cur, 'record_history', (prev_timestamp, channel_id, list(user_ids)))
+            self.run(cur, 'delete_history_before', (channel_id, prev_timestamp - retention))
+        return True
+
+    def delete_progress(self, channel_id: int):
+        with self.transaction() as cur:
+            self.run(cur, 'delete_progress', (channel_id,))
+
+    # progress_members
+    def get_member(self, channel_id: int, user_id: int) -> Optional[Tuple[int, int, int, int, int]]:
+        with self.transaction() as cur:
+            self.run(cur, 'get_member', (channel_id, user_id))
+            result = cur.fetchone()
+        return None if result is None else tuple(result)
+
+    # (user_id, score, streak)の一覧。集計ではこれだけを読み、以降はmodel.TallyStateの中で更新する。
+    def list_members(self, channel_id: int) -> List[Tuple[int, int, int]]:
+        with self.transaction() as cur:
+            self.run(cur, 'list_members', (channel_id,))
+            results = cur.fetchall()
+        return [(user_id, score, streak) for user_id, score, streak in results]
+
+    def add_member(self, channel_id: int, user_id: int):
+        with self.transaction() as cur:
+            self.run(cur, 'add_member', (channel_id, user_id))
+
+    def remove_member(self, channel_id: int, user_id: int):
+        with self.transaction() as cur:
+            self.run(cur, 'remove_member', (channel_id, user_id))
+
+    # streak以外は加算する値を渡す。
+    def update_member(self, channel_id: int, user_id: int, score: int, streak: int, total: int = 0, escape: int = 0,
+                      denied: int = 0):
+        with self.transaction() as cur:
+            self.run(cur, 'update_member', (score, total, streak, escape, denied, channel_id, user_id))
+
+    # 集計でまとめて更新する。(user_id, update_memberの引数)の一覧を1つのトランザクションで反映する。
+    def update_members(self, channel_id: int, updates: Iterable[Tuple[int, dict]]):
+        with self.transaction() as cur:
+            self.apply_member_updates(cur, channel_id, updates)
+
+    def apply_member_updates(self, cur, channel_id: int, updates: Iterable[Tuple[int, dict]]):
+        for user_id, update in updates:
+            self.run(cur, 'update_member', (update['score'], update.get('total', 0), update['streak'],
+                                            update.get('escape', 0), update.get('denied', 0), channel_id, user_id))
+
+    # progress_reports
+    def add_report(self, channel_id: int, message_id: int, user_id: int, timestamp: datetime.datetime):
+        with self.transaction() as cur:
+            self.run(cur, 'add_report', (channel_id, message_id, user_id, timestamp))
+
+    def list_reports(self, channel_id: int, start: datetime.datetime, end: datetime.datetime) -> List[Tuple[int, int]]:
+        with self.transaction() as cur:
+            self.run(cur, 'list_reports', (channel_id, start, end))
+            results = cur.fetchall()
+        return [(message_id, user_id) for message_id, user_id in results]
+
+    # どのprogressの集計にも使われなくなった報告の境界
+    def report_horizon(self, cur, now: datetime.datetime) -> datetime.datetime:
+        self.run(cur, 'report_horizon')
+        oldest, = cur.fetchone()
+        horizon = now - REPORT_RETENTION_FLOOR
+        return horizon if oldest is None else min(self.to_timestamp(oldest), horizon)
+
+    # 古い報告を削除する。定期的に呼ばれる。
+    def maintain_reports(self, now: datetime.datetime):
+        with self.transaction() as cur:
+            self.run(cur, 'delete_reports_before', (self.report_horizon(cur, now),))
+
+    # progress_history
+    def record_history(self, channel_id: int, user_ids: Iterable[int], timestamp: datetime.datetime,
+                       retention: datetime.timedelta):
+        with self.transaction() as cur:
+            self.run(cur, 'record_history', (timestamp, channel_id, list(user_ids)))
+            self.run(cur, 'delete_history_before', (channel_id, timestamp - retention))
+
+    def list_history(self, channel_id: int, user_id: int) -> List[Tuple[datetime.datetime, int, int]]:
+        with self.transaction() as cur:
+            self.run(cur, 'list_history', (channel_id, user_id))
+            results = cur.fetchall()
+        return [(self.to_timestamp(timestamp), score, streak) for timestamp, score, streak in results]
+
+
+# STATEMENTSはサーバー側でPREPAREしておき、実行時はEXECUTEでパラメータだけを送る。
+class PostgresStorage(Storage):
+    dialect = 'postgresql'
+
+    def __init__(self, url: str):
+        import psycopg2
+        super().__init__(database_connector=psycopg2.connect(url))
+        self.prepared = False
+
+    def prepare(self):
+        with self.transaction() as cur:
+            for name, sql in self.statements.items():
+                counter = iter(range(1, sql.count('%s') + 1))
+                cur.execute('PREPARE {} AS {}'.format(name, re.sub('%s', lambda _: '${}'.format(next(counter)), sql)))
+        self.prepared = True
+
+    def run(self, cur, name: str, params: Sequence = ()):
+        if not self.prepared:
+            return super().run(cur, name, params)
+        stats = self.stats[name]
+        if stats.planning_ms is None:
+            stats.planning_ms = self.explain(cur, self.statements[name], params)
+        stats.calls += 1
+        if len(params) == 0:
+            cur.execute('EXECUTE {}'.format(name))
+        else:
+            cur.execute('EXECUTE {} ({})'.format(name, ', '.join(['%s'] * len(params))), params)
+
+    def refresh_stats(self):
+        if not self.prepared or self.database_connector.server_version < 140000:
+            return
+        with self.transaction() as cur:
+            cur.execute('SELECT name, generic_plans FROM pg_prepared_statements')
+            results = cur.fetchall()
+        for name, generic_plans in results:
+            if name in self.stats:
+                self.stats[name].generic_plans = generic_plans
+
+    # 先の分割を作り、期限切れの分割は(設定されていればアーカイブしてから)切り離して削除する。
+    def maintain_reports(self, now: datetime.datetime):
+        with self.transaction() as cur:
+            partitions.create_future_partitions(cur, now)
+            dropped = partitions.drop_expired_partitions(cur, self.report_horizon(cur, now), partitions.ARCHIVE_DIR)
+        if len(dropped) > 0:
+            print('dropped report partitions: {}'.format(dropped))
+
+    # 準備していない場合の計画時間を1度だけ計測する。EXPLAINはANALYZEなしなので実行はされない。
+    # 計測に失敗しても本来の処理を続けられるようにSAVEPOINTの中で行う。
+    @staticmethod
+    def explain(cur, sql: str, params: Sequence) -> float:
+        cur.execute('SAVEPOINT explain_statement')
+        try:
+            cur.execute('EXPLAIN (SUMMARY) ' + sql, params)
+            lines = [line for line, in cur.fetchall()]
+        except Exception as e:
+            print('failed to explain statement: {!r}'.format(e))
+            cur.execute('ROLLBACK TO SAVEPOINT explain_statement')
+            return 0.0
+        cur.execute('RELEASE SAVEPOINT explain_statement')
+        for line in lines:
+            if line.startswith('Planning Time:'):
+                return float(line.split()[2])
+        return 0.0
+
+
+# 小規模な単一ノード向け。時刻はUNIX時間、間隔は秒数、時刻(TIME)は文字列で保存する。
+# escapeはSQLiteの予約語なので、SQLでは常に"escape"と引用符で囲む。
+# SQLiteはSQLの文字列ごとに準備済みの文をキャッシュするので、STATEMENTSの文字列が変わらないようにuser_idの配列はJSONで渡す。
+class SqliteStorage(Storage):
+    dialect = 'sqlite'
+    USER_IDS = 'user_id IN (SELECT value FROM json_each(%s))'
+
+    def __init__(self, path: str):
+        # トランザクションはbeginで明示的に開始する。
+        super().__init__(database_connector=sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False, cached_statements=len(STATEMENTS) * 2))
+        self.database_connector.execute('PRAGMA journal_mode=WAL')
+        self.database_connector.execute('PRAGMA synchronous=NORMAL')
+        self.database_connector.execute('PRAGMA busy_timeout=5000')
+
+    def begin(self, cur):
+        cur.execute('BEGIN IMMEDIATE')
+
+    def execute(self, cur, sql: str, params: Sequence = ()):
+        cur.execute(sql.replace('%s', '?'), [self.adapt(param) for param in params])
+
+    @staticmethod
+    def adapt(value):
+        if isinstance(value, datetime.datetime):
+            return value.timestamp()
+        if isinstance(value, datetime.timedelta):
+            return value.total_seconds()
+        if isinstance(value, datetime.time):
+            return value.replace(tzinfo=None).isoformat()
+        if isinstance(value, list):
+            return json.dumps(value)
+        return value
+
+    def to_timestamp(self, value) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(value, tz=ZONE_UTC)
+
+    def to_interval(self, value) -> datetime.timedelta:
+        return datetime.timedelta(seconds=value)
+
+    def to_time(self, value) -> datetime.time:
+        return datetime.time.fromisoformat(value)
+
+
+# DATABASE_URLがsqlite:///で始まればSQLite、それ以外はPostgreSQLとして接続する。
+def connect(url: str) -> Storage:
+    if url.startswith(SQLITE_URL_PREFIX):
+        return SqliteStorage(path=url[len(SQLITE_URL_PREFIX):])
+    return PostgresStorage(url=url)
@@ -0,0 +1,187 @@
+import datetime
+import itertools
+
+import discord
+
+BOT_ID = 1
+
+
+# Discordの代わり。テストで使う属性とメソッドだけを持つ。
+class FakeAsset:
+    def __init__(self, url: str):
+        self.url = url
+
+
+class FakeMember:
+    def __init__(self, _id: int, name: str):
+        self.id = _id
+        self.name = name
+        self.display_avatar = FakeAsset(url='https://example.com/{}.png'.format(_id))
+
+
+class FakeReaction:
+    def __init__(self, emoji: str, count: int):
+        self.emoji = emoji
+        self.count = count
+
+
+class FakeMessage:
+    def __init__(self, _id: int, created_at: datetime.datetime, embeds: list):
+        self.id = _id
+        self.created_at = created_at
+        self.embeds = embeds
+        self.reactions: list[FakeReaction] = []
+
+    async def add_reaction(self, emoji: str):
+        for reaction in self.reactions:
+            if reaction.emoji == emoji:
+                reaction.count += 1
+                return
+        self.reactions.append(FakeReaction(emoji=emoji, count=1))
+
+    async def edit(self, embed: discord.Embed):
+        self.embeds = [embed]
+
+
+class FakeHTTPResponse:
+    status = 404
+    reason = 'Not Found'
+
+
+class FakeGuild:
+    def __init__(self):
+        self.name = 'guild'
+        self.chunked = True
+
+    async def chunk(self, cache: bool = True):
+        pass
+
+
+# 送信されたメッセージと、discord.pyのViewStoreのように止められていないviewをメッセージごとに保持する。
+class FakeChannel:
+    def __init__(self, _id: int, members: list[FakeMember], clock: 'FakeClock'):
+        self.id = _id
+        self.name = 'progress'
+        self.guild = FakeGuild()
+        self.members = members
+        self.clock = clock
+        self.messages: dict[int, FakeMessage] = {}
+        self.views: dict[int, discord.ui.View] = {}
+
+    async def send(self, embed=None, embeds=None, files=None, view=None):
+        message = FakeMessage(_id=self.clock.snowflake(), created_at=self.clock.now,
+                              embeds=[embed] if embed is not None else embeds)
+        self.messages[message.id] = message
+        self.store_view(message.id, view)
+        return message
+
+    def store_view(self, message_id: int, view):
+        if view is not None:
+            self.views[message_id] = view
+        for _message_id in [_id for _id, _view in self.views.items() if _view.is_finished()]:
+            del self.views[_message_id]
+
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        if message_id not in self.messages:
+            raise discord.NotFound(FakeHTTPResponse(), 'Unknown Message')
+        return self.messages[message_id]
+
+    async def history(self, limit=None, after=None, before=None, oldest_first=False):
+        messages = sorted(self.messages.values(), key=lambda message: message.id, reverse=not oldest_first)
+        count = 0
+        for message in messages:
+            if after is not None and message.id <= after.id or before is not None and message.id >= before.id:
+                continue
+            if limit is not None and count >= limit:
+                return
+            count += 1
+            yield message
+
+    # 集計に使われなくなったメッセージを忘れる。
+    def forget_before(self, timestamp: datetime.datetime):
+        for message_id in [_id for _id, message in self.messages.items() if message.created_at < timestamp]:
+            del self.messages[message_id]
+            self.views.pop(message_id, None)
+
+
+class FakeClock:
+    def __init__(self, now: datetime.datetime):
+        self.now = now
+        self.counter = itertools.count()
+
+    # 送信時刻の順に並ぶID
+    def snowflake(self) -> int:
+        return discord.utils.time_snowflake(self.now) + next(self.counter) % (1 << 22)
+
+
+# 呼ばれたメソッドと引数をcallsに順に記録する。
+class FakeResponse:
+    def __init__(self, channel: FakeChannel):
+        self.channel = channel
+        self.message: FakeMessage | None = None
+        self.done = False
+        self.calls: list[tuple[str, dict]] = []
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def defer(self, **kwargs):
+        self.calls.append(('defer', kwargs))
+        self.done = True
+
+    async def send_message(self, embed: discord.Embed):
+        self.calls.append(('send_message', {'embed': embed}))
+        self.message = await self.channel.send(embed=embed)
+        self.done = True
+
+    async def edit_message(self, view=None, **kwargs):
+        self.calls.append(('edit_message', dict(kwargs, view=view)))
+        self.done = True
+
+
+class FakeInteraction:
+    def __init__(self, user: FakeMember, channel: FakeChannel, message: FakeMessage | None = None):
+        self.user = user
+        self.channel = channel
+        self.message = message
+        self.response = FakeResponse(channel=channel)
+
+    async def original_response(self) -> FakeMessage:
+        return self.response.message
+
+    async def edit_original_response(self, view=None, **kwargs):
+        self.response.calls.append(('edit_original_response', dict(kwargs, view=view)))
+        if view is not None and self.message is not None:
+            self.channel.store_view(self.message.id, view)
+
+
+class FakeContext:
+    def __init__(self, author: FakeMember, channel: FakeChannel):
+        self.author = author
+        self.channel = channel
+
+    async def send(self, embed: discord.Embed):
+        return await self.channel.send(embed=embed)
+
+
+class FakeAppCommandChannel:
+    def __init__(self, channel: FakeChannel):
+        self.channel = channel
+
+    def resolve(self) -> FakeChannel:
+        return self.channel
+
+
+class FakeBot:
+    def __init__(self):
+        self.user = FakeMember(_id=BOT_ID, name='bot')
+        self.channels: dict[int, FakeChannel] = {}
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+    def is_ready(self) -> bool:
+        return True
+
+    async def fetch_channel(self, channel_id: int):
+        raise discord.NotFound(FakeHTTPResponse(), 'Unknown Channel')
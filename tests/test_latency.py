@@ -0,0 +1,76 @@
+import asyncio
+import datetime
+
+import pytest
+
+discord = pytest.importorskip('discord')
+
+from source import latency  # noqa: E402
+from tests.fakes import FakeChannel, FakeClock, FakeInteraction, FakeMember  # noqa: E402
+
+ZONE_UTC = datetime.timezone.utc
+BUDGET = 0.05
+
+
+def make_interaction() -> FakeInteraction:
+    clock = FakeClock(now=datetime.datetime(2026, 10, 19, 3, 0, tzinfo=ZONE_UTC))
+    user = FakeMember(_id=100, name='member')
+    return FakeInteraction(user=user, channel=FakeChannel(_id=1000, members=[user], clock=clock))
+
+
+# sleepだけ待ってから、attachmentsを設定して編集するhandler
+async def handler(sleep: float, interaction: latency.BudgetedInteraction, attachments: list | None = None):
+    await asyncio.sleep(sleep)
+    interaction.response.attachments = attachments
+    await interaction.response.edit_message(embed=discord.Embed(title='done'), delete_after=10)
+
+
+def test_fast_handler_edits_response():
+    budget = latency.InteractionBudget(budget=BUDGET)
+    interaction = make_interaction()
+    asyncio.run(budget.run('fast', interaction, handler, sleep=0))
+    assert [name for name, _ in interaction.response.calls] == ['edit_message']
+    assert interaction.response.calls[0][1]['delete_after'] == 10
+    assert budget.calls['fast'] == 1
+    assert budget.deferred['fast'] == 0
+
+
+def test_slow_handler_is_deferred_when_budget_runs_out():
+    budget = latency.InteractionBudget(budget=BUDGET)
+    interaction = make_interaction()
+    attachments = [object()]
+    asyncio.run(budget.run('slow', interaction, handler, sleep=BUDGET * 3, attachments=attachments))
+    # 予算を超えた時点でdeferし、その後の編集は元のメッセージの編集になる。attachmentsは一緒に送られる。
+    assert [name for name, _ in interaction.response.calls] == ['defer', 'edit_original_response']
+    kwargs = interaction.response.calls[1][1]
+    assert kwargs['attachments'] is attachments
+    assert 'delete_after' not in kwargs
+    assert budget.calls['slow'] == 1
+    assert budget.deferred['slow'] == 1
+    assert budget.latencies['slow'][0] >= BUDGET * 3
+
+
+def test_predicted_slow_handler_is_deferred_first():
+    budget = latency.InteractionBudget(budget=BUDGET)
+    budget.latencies['predicted'].extend([BUDGET * 2] * latency.PREDICT_MIN_SAMPLES)
+    interaction = make_interaction()
+    asyncio.run(budget.run('predicted', interaction, handler, sleep=0))
+    # p90が予算を超えていれば、速く終わるときでも先にdeferする。
+    assert [name for name, _ in interaction.response.calls] == ['defer', 'edit_original_response']
+    assert budget.calls['predicted'] == 1
+    assert budget.deferred['predicted'] == 1
+
+
+def test_attachments_are_sent_once():
+    interaction = latency.BudgetedInteraction(interaction=make_interaction())
+    attachments = [object()]
+    interaction.response.attachments = attachments
+
+    async def edit():
+        await interaction.response.edit_message(embed=discord.Embed(title='first'))
+        await interaction.response.edit_message(embed=discord.Embed(title='second'))
+
+    asyncio.run(edit())
+    (_, first), (_, second) = interaction.interaction.response.calls
+    assert first['attachments'] is attachments
+    assert 'attachments' not in second
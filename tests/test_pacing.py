@@ -0,0 +1,58 @@
+import asyncio
+import datetime
+
+from source import model, pacing
+
+ZONE_UTC = datetime.timezone.utc
+
+
+def test_small_ticks_start_immediately():
+    assert pacing.spread_offsets(5, rate=2, window=120, jitter=3, burst=5) == [0.0] * 5
+
+
+def test_offsets_are_paced_by_rate():
+    # 少し超えただけなら、windowの端ではなくrateの間隔で並ぶ。
+    offsets = pacing.spread_offsets(7, rate=2, window=120, jitter=3, burst=5)
+    assert offsets[:5] == [0.0] * 5
+    assert 0.25 <= offsets[5] <= 0.5
+    assert 0.75 <= offsets[6] <= 1.0
+
+
+def test_offsets_are_bounded_by_window():
+    offsets = pacing.spread_offsets(1005, rate=2, window=120, jitter=3, burst=5)
+    assert offsets == sorted(offsets)
+    assert offsets[-1] <= 120
+
+
+def test_run_tallies_oldest_first():
+    now = datetime.datetime.now(tz=ZONE_UTC)
+    due = [model.ChannelState(channel_id, datetime.timedelta(days=1), datetime.time(),
+                              now - datetime.timedelta(seconds=channel_id), now, now) for channel_id in range(8)]
+    tallied = []
+
+    async def tally(progress: model.ChannelState):
+        tallied.append(progress.channel_id)
+
+    stats = asyncio.run(pacing.TallyPacer(rate=100, window=1, jitter=0, burst=5).run(due, tally))
+    assert tallied == list(reversed(range(8)))
+    assert stats.due == 8
+    assert stats.max_lateness >= 7
+
+
+def test_run_continues_after_failure():
+    now = datetime.datetime.now(tz=ZONE_UTC)
+    due = [model.ChannelState(channel_id, datetime.timedelta(days=1), datetime.time(),
+                              now - datetime.timedelta(seconds=channel_id), now, now) for channel_id in range(3)]
+    tallied = []
+
+    # 最も古いchannelが失敗しても、残りのchannelは集計される。
+    async def tally(progress: model.ChannelState):
+        if progress.channel_id == 2:
+            raise ValueError
+        tallied.append(progress.channel_id)
+
+    pacer = pacing.TallyPacer(rate=100, window=1, jitter=0, burst=5)
+    stats = asyncio.run(pacer.run(due, tally))
+    assert tallied == [1, 0]
+    assert stats.failed == [2]
+    assert pacer.ticks[-1] is stats
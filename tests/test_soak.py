@@ -0,0 +1,182 @@
+import asyncio
+import contextlib
+import datetime
+import gc
+import os
+import tracemalloc
+import weakref
+
+import pytest
+
+discord = pytest.importorskip('discord')
+# source.mainはsubmoduleのbaseを読み込む。submoduleがなければスキップする(README参照)。
+main = pytest.importorskip('source.main', exc_type=ImportError,
+                          reason='UtilityClasses_DiscordBot submodule is not checked out;'
+                                 ' run `git submodule update --init`')
+
+from source import model, storage  # noqa: E402
+from tests.fakes import (  # noqa: E402
+    FakeAppCommandChannel, FakeBot, FakeChannel, FakeClock, FakeContext, FakeInteraction, FakeMember)
+
+ZONE_UTC = datetime.timezone.utc
+CHANNEL_ID = 1000
+MEMBER_COUNT = 10
+# /progressは集計1回ごとにこの回数呼ばれる。最初の集計までにRunnerがMAX_RUNNERSを超えるようにする。
+RUNNERS_PER_ROUND = 4
+WARMUP_ROUNDS = main.MAX_RUNNERS // RUNNERS_PER_ROUND + 5
+SOAK_ROUNDS = 150
+# 集計のたびに増え続けていれば、SOAK_ROUNDS回でこれを超える。
+MAX_GROWTH_BYTES = 256 * 1024
+
+
+class Soak:
+    def __init__(self):
+        self.clock = FakeClock(now=datetime.datetime(2026, 10, 19, 3, 0, tzinfo=ZONE_UTC))
+        self.bot = FakeBot()
+        self.members = [FakeMember(_id=100 + i, name='member{}'.format(i)) for i in range(MEMBER_COUNT)]
+        self.channel = FakeChannel(_id=CHANNEL_ID, members=self.members + [self.bot.user], clock=self.clock)
+        self.bot.channels[CHANNEL_ID] = self.channel
+        self.cog = main.Progress(bot=self.bot)
+        self.cog.storage = storage.connect('sqlite:///:memory:')
+        self.cog.storage.migrate()
+        self.cog.storage.save_progress(channel_id=CHANNEL_ID, interval=datetime.timedelta(days=1),
+                                       _time=self.clock.now.time(), timestamp=self.clock.now)
+        for member in self.members:
+            self.cog.storage.add_member(channel_id=CHANNEL_ID, user_id=member.id)
+        # 解放されていないRunner
+        self.runners: weakref.WeakSet = weakref.WeakSet()
+        self.rounds = 0
+
+    # 1日分の操作。/progressのメニューを開いて操作し、何人かが/reportで報告してリアクションを付け、最後に集計する。
+    async def round(self):
+        progress = await self.operate()
+        await self.cog.tally_channel(progress=progress, now=self.clock.now)
+        self.cog.prune_runners()
+        self.cog.storage.maintain_reports(now=self.clock.now)
+        self.channel.forget_before(progress.prev_timestamp)
+        self.rounds += 1
+
+    # 集計の直前までの操作。時計を予定時刻に進め、集計するprogressを返す。
+    async def operate(self) -> model.ChannelState:
+        row, = self.cog.storage.list_progress()
+        progress = model.ChannelState(*row)
+        for i in range(RUNNERS_PER_ROUND):
+            author = self.members[(self.rounds + i) % MEMBER_COUNT]
+            await self.cog.progress.callback(self.cog, FakeContext(author=author, channel=self.channel))
+            runner = self.cog.runners[-1]
+            self.runners.add(runner)
+            await runner.select_channel(values=[FakeAppCommandChannel(channel=self.channel)],
+                                        interaction=FakeInteraction(user=author, channel=self.channel))
+            await runner.member(interaction=FakeInteraction(user=author, channel=self.channel))
+            await runner.back_menu(interaction=FakeInteraction(user=author, channel=self.channel))
+
+        self.clock.now = progress.prev_timestamp + datetime.timedelta(hours=1)
+        for member in self.members[self.rounds % 3::2]:
+            interaction = FakeInteraction(user=member, channel=self.channel)
+            await self.cog.report.callback(self.cog, interaction, 'progress', None, None, None)
+            message = interaction.response.message
+            for _ in self.members[:self.rounds % 4]:
+                await message.add_reaction(main.THINKING_FACE.text)
+
+        self.clock.now = progress.timestamp
+        return progress
+
+
+def traced() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def test_soak_memory_is_bounded():
+    async def run():
+        # tracemallocは開始後に確保したメモリだけを数えるので、Runnerが入れ替わり始めるまでの準備も計測中に行う。
+        tracemalloc.start()
+        try:
+            soak = Soak()
+            for _ in range(WARMUP_ROUNDS):
+                await soak.round()
+            before = traced()
+            for _ in range(SOAK_ROUNDS):
+                await soak.round()
+            growth = traced() - before
+        finally:
+            tracemalloc.stop()
+        return soak, growth
+
+    # printの出力が溜まって増えたように見えないように、出力は捨てる。
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        soak, growth = asyncio.run(run())
+    assert growth < MAX_GROWTH_BYTES, '{} bytes grew in {} rounds'.format(growth, SOAK_ROUNDS)
+    assert len(soak.cog.runners) <= main.MAX_RUNNERS
+    # 破棄したRunnerのviewは止められ、Runnerごと解放される。
+    assert len(soak.channel.views) <= main.MAX_RUNNERS
+    gc.collect()
+    assert len(soak.runners) <= main.MAX_RUNNERS
+    # 集計は毎回進み、報告や履歴は保持期間を超えて残らない。
+    row, = soak.cog.storage.list_progress()
+    assert model.ChannelState(*row).timestamp == soak.clock.now + datetime.timedelta(days=1)
+    reports = soak.cog.storage.list_reports(channel_id=CHANNEL_ID, start=soak.clock.now - datetime.timedelta(
+        days=365), end=soak.clock.now)
+    assert len(reports) <= MEMBER_COUNT * (storage.REPORT_RETENTION_FLOOR.days + 1)
+    history = soak.cog.storage.list_history(channel_id=CHANNEL_ID, user_id=soak.members[0].id)
+    assert len(history) <= main.HISTORY_RETENTION.days + 1
+
+
+def test_pruned_runner_views_are_stopped():
+    async def run():
+        soak = Soak()
+        for _ in range(WARMUP_ROUNDS):
+            await soak.round()
+        kept = list(soak.cog.runners)
+        for _ in range(main.MAX_RUNNERS // RUNNERS_PER_ROUND + 1):
+            await soak.round()
+        return soak, kept
+
+    soak, kept = asyncio.run(run())
+    pruned = [runner for runner in kept if runner not in soak.cog.runners]
+    assert len(pruned) > 0
+    for runner in pruned:
+        assert all(item.view is None or item.view.is_finished() for item in runner.progress_window.items)
+
+
+def test_cancelled_tally_is_not_applied():
+    async def run():
+        soak, reference = Soak(), Soak()
+        for _soak in [soak, reference]:
+            for _ in range(3):
+                await _soak.round()
+        progress = await soak.operate()
+        members = sorted(soak.cog.storage.list_members(channel_id=CHANNEL_ID))
+        history = soak.cog.storage.list_history(channel_id=CHANNEL_ID, user_id=soak.members[0].id)
+
+        # 集計結果の送信中に取り消す。
+        send = soak.channel.send
+        sending = asyncio.Event()
+
+        async def blocked_send(**kwargs):
+            sending.set()
+            await asyncio.Event().wait()
+
+        soak.channel.send = blocked_send
+        task = asyncio.create_task(soak.cog.tally_channel(progress=progress, now=soak.clock.now))
+        await sending.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert sorted(soak.cog.storage.list_members(channel_id=CHANNEL_ID)) == members
+        assert soak.cog.storage.list_history(channel_id=CHANNEL_ID, user_id=soak.members[0].id) == history
+        row, = soak.cog.storage.list_progress()
+        assert model.ChannelState(*row).timestamp == progress.timestamp
+
+        # やり直した集計は、取り消されなかった集計と同じ結果になる。
+        soak.channel.send = send
+        await soak.cog.tally_channel(progress=model.ChannelState(*row), now=soak.clock.now)
+        await reference.round()
+        return soak, reference, members
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        soak, reference, members = asyncio.run(run())
+    tallied = sorted(soak.cog.storage.list_members(channel_id=CHANNEL_ID))
+    assert tallied != members
+    assert tallied == sorted(reference.cog.storage.list_members(channel_id=CHANNEL_ID))
+    assert soak.cog.storage.list_progress() == reference.cog.storage.list_progress()
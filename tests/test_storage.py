@@ -0,0 +1,180 @@
+import datetime
+import os
+
+import pytest
+
+from source import storage
+
+ZONE_UTC = datetime.timezone.utc
+# 同じデータベースを使っていても他のデータと重ならないチャンネルID
+CHANNEL_ID = 9_000_000_000_000_001
+OTHER_CHANNEL_ID = 9_000_000_000_000_002
+USER_IDS = [9_000_000_000_000_011, 9_000_000_000_000_012, 9_000_000_000_000_013]
+NOW = datetime.datetime(2026, 10, 19, 12, 0, tzinfo=ZONE_UTC)
+INTERVAL = datetime.timedelta(days=1)
+
+# SQLiteでは常に、PROGRESS_TEST_DATABASE_URLが設定されていればPostgreSQLでも同じテストを実行する。
+# migrateを実行して行を追加・削除するので、本番用のDATABASE_URLは使わず、テスト用のデータベースを明示的に指定させる。
+TEST_DATABASE_URL = os.getenv('PROGRESS_TEST_DATABASE_URL')
+URLS = ['sqlite:///:memory:']
+if TEST_DATABASE_URL and not TEST_DATABASE_URL.startswith(storage.SQLITE_URL_PREFIX):
+    URLS.append(TEST_DATABASE_URL)
+
+
+def cleanup(_storage: storage.Storage):
+    channel_ids = [CHANNEL_ID, OTHER_CHANNEL_ID]
+    with _storage.transaction() as cur:
+        for table in ['progress', 'progress_members', 'progress_reports', 'progress_history']:
+            for channel_id in channel_ids:
+                _storage.execute(cur, 'DELETE FROM {} WHERE channel_id = %s'.format(table), (channel_id,))
+
+
+@pytest.fixture(params=URLS, ids=lambda url: url.split(':', 1)[0])
+def db(request):
+    _storage = storage.connect(request.param)
+    _storage.migrate()
+    _storage.prepare()
+    cleanup(_storage)
+    yield _storage
+    cleanup(_storage)
+    _storage.close()
+
+
+def test_migrate_is_idempotent(db):
+    version = db.migrate()
+    assert db.migrate() == version
+
+
+def test_progress(db):
+    _time = datetime.time(hour=3, minute=5)
+    assert db.get_progress(channel_id=CHANNEL_ID) is None
+    db.save_progress(channel_id=CHANNEL_ID, interval=INTERVAL, _time=_time, timestamp=NOW)
+    assert db.get_progress(channel_id=CHANNEL_ID) == (INTERVAL, _time, NOW)
+    rows = [row for row in db.list_progress() if row[0] == CHANNEL_ID]
+    assert rows == [(CHANNEL_ID, INTERVAL, _time, NOW, NOW - INTERVAL, NOW - INTERVAL * 2)]
+    assert _time in db.list_progress_times()
+
+    # 登録済みなら間隔と時刻と次回の時刻だけが変わる。
+    _time = datetime.time(hour=4, minute=10)
+    db.save_progress(channel_id=CHANNEL_ID, interval=INTERVAL * 2, _time=_time, timestamp=NOW + INTERVAL)
+    assert db.get_progress(channel_id=CHANNEL_ID) == (INTERVAL * 2, _time, NOW + INTERVAL)
+
+    db.advance_progress(channel_id=CHANNEL_ID, timestamp=NOW + INTERVAL * 3, prev_timestamp=NOW + INTERVAL,
+                        prev_prev_timestamp=NOW)
+    rows = [row for row in db.list_progress() if row[0] == CHANNEL_ID]
+    assert rows == [(CHANNEL_ID, INTERVAL * 2, _time, NOW + INTERVAL * 3, NOW + INTERVAL, NOW)]
+
+    # 予定時刻が変更されていれば進めない。
+    db.save_progress(channel_id=CHANNEL_ID, interval=INTERVAL * 2, _time=_time, timestamp=NOW + INTERVAL * 5)
+    db.advance_progress(channel_id=CHANNEL_ID, timestamp=NOW + INTERVAL * 5, prev_timestamp=NOW + INTERVAL * 3,
+                        prev_prev_timestamp=NOW + INTERVAL)
+    assert db.get_progress(channel_id=CHANNEL_ID) == (INTERVAL * 2, _time, NOW + INTERVAL * 5)
+    rows = [row for row in db.list_progress() if row[0] == CHANNEL_ID]
+    assert rows == [(CHANNEL_ID, INTERVAL * 2, _time, NOW + INTERVAL * 5, NOW + INTERVAL, NOW)]
+
+    db.delete_progress(channel_id=CHANNEL_ID)
+    assert db.get_progress(channel_id=CHANNEL_ID) is None
+
+
+def test_members(db):
+    user_id, other_user_id, _ = USER_IDS
+    assert db.get_member(channel_id=CHANNEL_ID, user_id=user_id) is None
+    db.add_member(channel_id=CHANNEL_ID, user_id=user_id)
+    db.add_member(channel_id=CHANNEL_ID, user_id=other_user_id)
+    db.add_member(channel_id=OTHER_CHANNEL_ID, user_id=user_id)
+    assert db.get_member(channel_id=CHANNEL_ID, user_id=user_id) == (0, 0, 0, 0, 0)
+
+    # streak以外は加算される。
+    db.update_member(channel_id=CHANNEL_ID, user_id=user_id, score=110, streak=1, total=1)
+    db.update_member(channel_id=CHANNEL_ID, user_id=user_id, score=-40, streak=-1, denied=1)
+    db.update_member(channel_id=CHANNEL_ID, user_id=user_id, score=-10, streak=-1, escape=1)
+    assert db.get_member(channel_id=CHANNEL_ID, user_id=user_id) == (60, 1, -1, 1, 1)
+    assert sorted(db.list_members(channel_id=CHANNEL_ID)) == sorted([(user_id, 60, -1), (other_user_id, 0, 0)])
+    assert db.list_members(channel_id=OTHER_CHANNEL_ID) == [(user_id, 0, 0)]
+
+    db.update_members(channel_id=CHANNEL_ID, updates=[
+        (user_id, {'score': 10, 'streak': 1, 'total': 1}), (other_user_id, {'score': -10, 'streak': -1, 'escape': 1})])
+    assert db.get_member(channel_id=CHANNEL_ID, user_id=user_id) == (70, 2, 1, 1, 1)
+    assert db.get_member(channel_id=CHANNEL_ID, user_id=other_user_id) == (-10, 0, -1, 1, 0)
+
+    db.remove_member(channel_id=CHANNEL_ID, user_id=user_id)
+    assert db.get_member(channel_id=CHANNEL_ID, user_id=user_id) is None
+    assert db.list_members(channel_id=CHANNEL_ID) == [(other_user_id, -10, -1)]
+
+
+def test_reports(db):
+    user_id, other_user_id, _ = USER_IDS
+    db.add_report(channel_id=CHANNEL_ID, message_id=1, user_id=user_id, timestamp=NOW - INTERVAL)
+    db.add_report(channel_id=CHANNEL_ID, message_id=2, user_id=other_user_id, timestamp=NOW - INTERVAL / 2)
+    db.add_report(channel_id=CHANNEL_ID, message_id=3, user_id=user_id, timestamp=NOW)
+    db.add_report(channel_id=OTHER_CHANNEL_ID, message_id=4, user_id=user_id, timestamp=NOW - INTERVAL / 2)
+    # 期間は開始を含み、終了を含まない。
+    assert sorted(db.list_reports(channel_id=CHANNEL_ID, start=NOW - INTERVAL, end=NOW)) == [
+        (1, user_id), (2, other_user_id)]
+    assert db.list_reports(channel_id=CHANNEL_ID, start=NOW, end=NOW + INTERVAL) == [(3, user_id)]
+
+
+def test_maintain_reports(db):
+    user_id = USER_IDS[0]
+    # 前々回の時刻より前で、かつ保持する最短の期間も過ぎた報告だけが削除される。
+    prev_prev_timestamp = NOW - storage.REPORT_RETENTION_FLOOR - INTERVAL * 7
+    db.save_progress(channel_id=CHANNEL_ID, interval=INTERVAL, _time=datetime.time(), timestamp=NOW)
+    db.advance_progress(channel_id=CHANNEL_ID, timestamp=NOW + INTERVAL, prev_timestamp=NOW,
+                        prev_prev_timestamp=prev_prev_timestamp)
+    db.add_report(channel_id=CHANNEL_ID, message_id=1, user_id=user_id,
+                  timestamp=prev_prev_timestamp - INTERVAL * 14)
+    db.add_report(channel_id=CHANNEL_ID, message_id=2, user_id=user_id, timestamp=prev_prev_timestamp)
+    db.add_report(channel_id=CHANNEL_ID, message_id=3, user_id=user_id, timestamp=NOW - INTERVAL)
+    db.maintain_reports(now=NOW)
+    assert sorted(db.list_reports(channel_id=CHANNEL_ID, start=NOW - INTERVAL * 365, end=NOW)) == [
+        (2, user_id), (3, user_id)]
+
+
+def test_history(db):
+    user_id, other_user_id, absent_user_id = USER_IDS
+    for _user_id in [user_id, other_user_id, absent_user_id]:
+        db.add_member(channel_id=CHANNEL_ID, user_id=_user_id)
+    retention = INTERVAL * 7
+    db.update_member(channel_id=CHANNEL_ID, user_id=user_id, score=110, streak=1, total=1)
+    db.record_history(channel_id=CHANNEL_ID, user_ids=[user_id, other_user_id], timestamp=NOW - INTERVAL * 10,
+                      retention=retention)
+    db.record_history(channel_id=CHANNEL_ID, user_ids=[user_id, other_user_id], timestamp=NOW - INTERVAL,
+                      retention=retention)
+    db.update_member(channel_id=CHANNEL_ID, user_id=user_id, score=120, streak=2, total=1)
+    db.record_history(channel_id=CHANNEL_ID, user_ids=[user_id, other_user_id], timestamp=NOW,
+                      retention=retention)
+    # 同じ時刻の記録は上書きしない。
+    db.update_member(channel_id=CHANNEL_ID, user_id=user_id, score=130, streak=3, total=1)
+    db.record_history(channel_id=CHANNEL_ID, user_ids=[user_id], timestamp=NOW, retention=retention)
+
+    # 保持期間より古い記録は削除される。
+    assert db.list_history(channel_id=CHANNEL_ID, user_id=user_id) == [
+        (NOW - INTERVAL, 110, 1), (NOW, 230, 2)]
+    assert db.list_history(channel_id=CHANNEL_ID, user_id=other_user_id) == [(NOW - INTERVAL, 0, 0), (NOW, 0, 0)]
+    assert db.list_history(channel_id=CHANNEL_ID, user_id=absent_user_id) == []
+
+
+def test_finish_tally(db):
+    user_id, other_user_id, _ = USER_IDS
+    db.save_progress(channel_id=CHANNEL_ID, interval=INTERVAL, _time=datetime.time(), timestamp=NOW)
+    for _user_id in [user_id, other_user_id]:
+        db.add_member(channel_id=CHANNEL_ID, user_id=_user_id)
+    # 同じメンバーの更新は順に反映される。
+    updates = [(user_id, {'score': 110, 'streak': 1, 'total': 1}),
+               (other_user_id, {'score': -10, 'streak': -1, 'escape': 1}),
+               (user_id, {'score': 0, 'streak': 1})]
+    assert db.finish_tally(channel_id=CHANNEL_ID, updates=updates, user_ids=[user_id, other_user_id],
+                           timestamp=NOW + INTERVAL, prev_timestamp=NOW, prev_prev_timestamp=NOW - INTERVAL,
+                           retention=INTERVAL * 7)
+    assert db.get_progress(channel_id=CHANNEL_ID) == (INTERVAL, datetime.time(), NOW + INTERVAL)
+    assert db.get_member(channel_id=CHANNEL_ID, user_id=user_id) == (110, 1, 1, 0, 0)
+    assert db.list_history(channel_id=CHANNEL_ID, user_id=user_id) == [(NOW, 110, 1)]
+    assert db.list_history(channel_id=CHANNEL_ID, user_id=other_user_id) == [(NOW, -10, -1)]
+
+    # 予定時刻が変わっていれば、同じ集計をもう一度反映しようとしても何も変わらない。
+    assert not db.finish_tally(channel_id=CHANNEL_ID, updates=updates, user_ids=[user_id, other_user_id],
+                               timestamp=NOW + INTERVAL, prev_timestamp=NOW, prev_prev_timestamp=NOW - INTERVAL,
+                               retention=INTERVAL * 7)
+    assert db.get_progress(channel_id=CHANNEL_ID) == (INTERVAL, datetime.time(), NOW + INTERVAL)
+    assert db.get_member(channel_id=CHANNEL_ID, user_id=user_id) == (110, 1, 1, 0, 0)
+    assert db.list_history(channel_id=CHANNEL_ID, user_id=user_id) == [(NOW, 110, 1)]